@@ -0,0 +1,51 @@
+import argparse
+import json
+import subprocess
+import sys
+from typing import Dict, List
+
+STATEMENT = "from provisio import get_service_provision"
+
+
+def import_time(statement: str) -> Dict[str, float]:
+    """Wall time of ``statement`` in a fresh interpreter and cumulative import times of the modules it loaded."""
+    code = f"import time; start = time.perf_counter(); {statement}; print(time.perf_counter() - start)"
+    run = subprocess.run([sys.executable, "-X", "importtime", "-c", code], capture_output=True, text=True, check=True)
+    modules = {}
+    for line in run.stderr.splitlines():
+        if not line.startswith("import time:") or "|" not in line:
+            continue
+        _, cumulative, module = line.split("|")
+        if cumulative.strip().isdigit():
+            modules[module.strip()] = int(cumulative) / 1e6
+    return {"wall_time_s": float(run.stdout.strip().splitlines()[-1]), "modules": modules}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Measure cold import time of provisio in fresh interpreters.")
+    parser.add_argument("--statement", default=STATEMENT)
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--top", type=int, default=15, help="number of slowest top-level imports to show")
+    parser.add_argument("--max-seconds", type=float, help="exit with an error if the best time exceeds this")
+    parser.add_argument("--output", help="path to write JSON results to")
+    args = parser.parse_args()
+
+    runs: List[dict] = [import_time(args.statement) for _ in range(args.repeat)]
+    best = min(runs, key=lambda run: run["wall_time_s"])
+    print(f"{args.statement}: best {best['wall_time_s']:.3f} s of {args.repeat} runs")
+    # cumulative time of a package covers its submodules and packages it imported first
+    top_level = sorted(
+        ((module, seconds) for module, seconds in best["modules"].items() if "." not in module),
+        key=lambda item: -item[1],
+    )
+    for module, seconds in top_level[: args.top]:
+        print(f"{module:>30}: {seconds:.3f} s")
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump({"statement": args.statement, "runs": [run["wall_time_s"] for run in runs], **best}, f, indent=2)
+    if args.max_seconds is not None and best["wall_time_s"] > args.max_seconds:
+        sys.exit(f"Import took {best['wall_time_s']:.3f} s, more than {args.max_seconds} s")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,146 @@
+import argparse
+import json
+import platform
+import subprocess
+import sys
+import time
+import tracemalloc
+from typing import Callable, Dict, List
+
+import numpy as np
+from loguru import logger
+from scipy import sparse
+from synthetic_city import generate_city
+
+import provisio
+from provisio.provision_logic import CityProvision
+from provisio.utils import additional_options, provision_matrix_transform
+
+CASES = {
+    "small": {"n_buildings": 2_000, "n_services": 100},
+    "medium": {"n_buildings": 20_000, "n_services": 500},
+    "large": {"n_buildings": 100_000, "n_services": 2_000},
+}
+STAGES = ("validation", "gravity", "gravity_expected", "linear", "additional_options", "provision_matrix_transform")
+
+
+def measure(func: Callable, repeat: int) -> Dict[str, float]:
+    """Best wall time over ``repeat`` runs and peak traced memory of one more run."""
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        times.append(time.perf_counter() - start)
+    tracemalloc.start()
+    func()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return {"wall_time_s": min(times), "peak_memory_mb": peak / 2**20}
+
+
+def run_case(name: str, threshold: int, stages: List[str], repeat: int, seed: int) -> List[dict]:
+    buildings, services, matrix = generate_city(**CASES[name], seed=seed)
+    logger.info(
+        "Case {}: {} buildings, {} services, {} reachable pairs", name, len(buildings), len(services), matrix.nnz
+    )
+
+    def _city_provision(calculation_type="gravity"):
+        return CityProvision(
+            services=services,
+            demanded_buildings=buildings,
+            adjacency_matrix=matrix,
+            threshold=threshold,
+            calculation_type=calculation_type,
+        )
+
+    city = _city_provision()
+    distances = city._distance_matrix  # pylint: disable=protected-access
+    demand = city.demanded_buildings["demand"].to_numpy(float)
+    capacity = city.services["capacity"].to_numpy(float)
+    flows = CityProvision._solve(demand, capacity, distances, threshold, "gravity")  # pylint: disable=protected-access
+    destination = sparse.csr_matrix((flows, distances.indices, distances.indptr), shape=distances.shape)
+
+    stage_funcs = {
+        "validation": _city_provision,
+        "gravity": lambda: CityProvision._solve(  # pylint: disable=protected-access
+            demand, capacity, distances, threshold, "gravity"
+        ),
+        "gravity_expected": lambda: CityProvision._solve(  # pylint: disable=protected-access
+            demand, capacity, distances, threshold, "gravity_expected"
+        ),
+        "linear": lambda: CityProvision._solve(  # pylint: disable=protected-access
+            demand, capacity, distances, threshold, "linear"
+        ),
+        "additional_options": lambda: additional_options(
+            city.demanded_buildings.copy(), city.services.copy(), distances, destination, threshold
+        ),
+        "provision_matrix_transform": lambda: provision_matrix_transform(
+            destination, city.services, city.demanded_buildings, distances
+        ),
+    }
+    results = []
+    for stage in stages:
+        result = {"case": name, "stage": stage, **measure(stage_funcs[stage], repeat)}
+        logger.info(
+            "{:>10} {:>28}: {:9.3f} s, {:9.1f} MB", name, stage, result["wall_time_s"], result["peak_memory_mb"]
+        )
+        results.append(result)
+    return results
+
+
+def compare(results: List[dict], baseline_path: str):
+    with open(baseline_path, encoding="utf-8") as f:
+        baseline = {(r["case"], r["stage"]): r for r in json.load(f)["results"]}
+    for result in results:
+        base = baseline.get((result["case"], result["stage"]))
+        if base is None:
+            continue
+        logger.info(
+            "{:>10} {:>28}: time x{:.2f}, memory x{:.2f} against {}",
+            result["case"],
+            result["stage"],
+            result["wall_time_s"] / base["wall_time_s"],
+            result["peak_memory_mb"] / max(base["peak_memory_mb"], 1e-9),
+            baseline_path,
+        )
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark provisio stages on synthetic cities.")
+    parser.add_argument("--cases", nargs="+", choices=list(CASES), default=["small", "medium"])
+    parser.add_argument("--stages", nargs="+", choices=STAGES, default=list(STAGES))
+    parser.add_argument("--threshold", type=int, default=10)
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", help="path to write JSON results to")
+    parser.add_argument("--compare", help="path to JSON results of a previous run to compare with")
+    args = parser.parse_args()
+
+    logger.remove()
+    logger.add(sys.stderr, level="INFO")
+    results = []
+    for case in args.cases:
+        results.extend(run_case(case, args.threshold, args.stages, args.repeat, args.seed))
+
+    try:
+        commit = subprocess.run(["git", "rev-parse", "HEAD"], capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    report = {
+        "commit": commit,
+        "provisio_version": provisio.__version__,
+        "python": platform.python_version(),
+        "numpy": np.__version__,
+        "threshold": args.threshold,
+        "seed": args.seed,
+        "results": results,
+    }
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(report, f, indent=2)
+    if args.compare:
+        compare(results, args.compare)
+
+
+if __name__ == "__main__":
+    main()
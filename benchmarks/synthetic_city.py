@@ -0,0 +1,68 @@
+from typing import Tuple
+
+import geopandas as gpd
+import numpy as np
+import shapely
+from scipy import sparse
+from scipy.spatial import cKDTree
+
+
+def generate_city(
+    n_buildings: int,
+    n_services: int,
+    size: float = 20_000,
+    n_clusters: int = 12,
+    max_distance: float = 60,
+    speed: float = 80,
+    population_mean: float = 120,
+    capacity_mean: float = 300,
+    footprints: bool = True,
+    seed: int = 0,
+) -> Tuple[gpd.GeoDataFrame, gpd.GeoDataFrame, sparse.coo_matrix]:
+    """Generate a synthetic city with buildings, services and a sparse adjacency matrix between them.
+
+    Buildings and services are scattered around a number of gaussian districts. Distances are travel times
+    in minutes along a straight line at ``speed`` meters per minute, stretched by a random detour factor,
+    and only pairs within ``max_distance`` are stored, which gives the sparsity of a real pruned matrix.
+
+    Args:
+        n_buildings (int): number of buildings.
+        n_services (int): number of services.
+        size (float): side of the square city extent in meters.
+        n_clusters (int): number of districts buildings and services are concentrated in.
+        max_distance (float): maximum stored distance in minutes.
+        speed (float): travel speed in meters per minute.
+        population_mean (float): mean of the lognormal population of a building.
+        capacity_mean (float): mean of the lognormal capacity of a service.
+        footprints (bool): make buildings square polygons instead of points.
+        seed (int): random seed.
+
+    Returns:
+        Tuple[gpd.GeoDataFrame, gpd.GeoDataFrame, sparse.coo_matrix]: buildings with "population" and "demand"
+        columns, services with "capacity" column and buildings x services matrix of distances.
+    """
+    rng = np.random.default_rng(seed)
+    centers = rng.uniform(0, size, (n_clusters, 2))
+    spread = rng.uniform(size / 40, size / 10, n_clusters)
+
+    def _points(n):
+        cluster = rng.integers(0, n_clusters, n)
+        return np.clip(centers[cluster] + rng.normal(size=(n, 2)) * spread[cluster, None], 0, size)
+
+    buildings_xy, services_xy = _points(n_buildings), _points(n_services)
+    population = np.round(rng.lognormal(np.log(population_mean) - 0.5, 1, n_buildings))
+    capacity = np.maximum(np.round(rng.lognormal(np.log(capacity_mean) - 0.125, 0.5, n_services)), 1)
+
+    geometry = shapely.points(buildings_xy)
+    if footprints:
+        geometry = shapely.box(*(buildings_xy - 8).T, *(buildings_xy + 8).T)
+    buildings = gpd.GeoDataFrame(
+        {"population": population, "demand": np.maximum(np.round(population * 0.1), 1)}, geometry=geometry, crs=32636
+    )
+    services = gpd.GeoDataFrame({"capacity": capacity}, geometry=shapely.points(services_xy), crs=32636)
+
+    matrix = cKDTree(buildings_xy).sparse_distance_matrix(
+        cKDTree(services_xy), max_distance * speed, output_type="coo_matrix"
+    )
+    matrix.data = np.round(matrix.data / speed * rng.uniform(1.1, 1.6, matrix.nnz), 1)
+    return buildings, services, matrix
@@ -1,4 +1,15 @@
 __version__ = "0.1.7"
 
-from .provisio import demands_from_buildings_by_normative, get_service_provision
-from .utils import is_shown
+from .adjacency import AdjacencyMatrix, load_adjacency_matrix, save_adjacency_matrix
+from .cache import ProvisionCache
+from .instrumentation import ProvisionMetrics, StallGuard
+from .jobs import ProvisionJob, ProvisionJobQueue
+from .provisio import (
+    demands_from_buildings_by_normative,
+    get_service_accessibility,
+    get_service_provision,
+    get_service_provision_batch,
+    get_service_provision_joint,
+)
+from .provisio_exceptions import ProvisionCancelledError
+from .utils import is_shown, write_links
@@ -0,0 +1,165 @@
+import os
+from typing import Optional, Union
+
+import numpy as np
+import pandas as pd
+from pydantic import BaseModel, InstanceOf
+from scipy import sparse
+
+from .provisio_exceptions import AdjacencyMatrixValueError
+from .utils import EDGE_TABLE_COLUMNS, adjacency_to_csr, csr_rows_positions, positions_to_csr
+
+_ARRAYS = ("data", "indices", "indptr", "buildings_index", "services_index")
+
+
+class AdjacencyMatrix(BaseModel):
+    """
+    Adjacency matrix between buildings and services stored as a sparse services x buildings matrix with labels.
+
+    Args:
+        matrix (InstanceOf[sparse.csr_matrix]): distances with services as rows and buildings as columns, only stored
+            entries are considered reachable. Its arrays may be memory-mapped.
+        buildings_index (InstanceOf[pd.Index]): labels of matrix columns.
+        services_index (InstanceOf[pd.Index]): labels of matrix rows.
+    """
+
+    matrix: InstanceOf[sparse.csr_matrix]
+    buildings_index: InstanceOf[pd.Index]
+    services_index: InstanceOf[pd.Index]
+
+    def select(self, buildings_index: pd.Index, services_index: pd.Index) -> sparse.csr_matrix:
+        """Select rows and columns of the matrix by labels.
+
+        Only the selected rows are read, the matrix itself is returned without copying if it already matches
+        the given labels.
+
+        Args:
+            buildings_index (pd.Index): labels of buildings, defines the order of resulting columns.
+            services_index (pd.Index): labels of services, defines the order of resulting rows.
+
+        Returns:
+            sparse.csr_matrix: services x buildings matrix, labels missing in the stored matrix get no entries.
+        """
+        if self.buildings_index.equals(buildings_index) and self.services_index.equals(services_index):
+            return self.matrix
+        rows = self.services_index.get_indexer(services_index)
+        cols = buildings_index.get_indexer(self.buildings_index)
+        edges, indptr = csr_rows_positions(self.matrix.indptr, rows)
+        indices = cols[self.matrix.indices[edges]]
+        keep = indices >= 0
+        row = np.repeat(np.arange(len(rows)), np.diff(indptr))[keep]
+        indptr = np.concatenate(([0], np.cumsum(np.bincount(row, minlength=len(rows)))))
+        matrix = sparse.csr_matrix(
+            (self.matrix.data[edges][keep], indices[keep], indptr), shape=(len(services_index), len(buildings_index))
+        )
+        matrix.sort_indices()
+        return matrix
+
+
+def sparse_to_adjacency_matrix(
+    matrix: Union[sparse.spmatrix, sparse.sparray], buildings_index: pd.Index, services_index: pd.Index
+) -> AdjacencyMatrix:
+    """Label a positional sparse buildings x services distance matrix without building an edge table.
+
+    Args:
+        matrix (sparse.spmatrix | sparse.sparray): matrix with rows positionally matching ``buildings_index`` and
+            columns positionally matching ``services_index``. Only stored finite entries (explicit zeros included)
+            are treated as reachable pairs, duplicated entries keep the shortest distance.
+        buildings_index (pd.Index): index of buildings GeoDataFrame.
+        services_index (pd.Index): index of services GeoDataFrame.
+
+    Returns:
+        AdjacencyMatrix: transposed matrix with labels.
+    """
+    if matrix.shape != (len(buildings_index), len(services_index)):
+        raise AdjacencyMatrixValueError
+    matrix = sparse.coo_matrix(matrix)
+    keep = np.isfinite(matrix.data)
+    return AdjacencyMatrix(
+        matrix=positions_to_csr(
+            matrix.col[keep], matrix.row[keep], matrix.data[keep].astype(float), matrix.shape[::-1]
+        ),
+        buildings_index=buildings_index.astype(int),
+        services_index=services_index,
+    )
+
+
+def select_adjacency_matrix(
+    adjacency_matrix: Union[pd.DataFrame, AdjacencyMatrix], buildings_index: pd.Index, services_index: pd.Index
+) -> sparse.csr_matrix:
+    """Build a services x buildings sparse distance matrix aligned with the given indexes from any labelled matrix."""
+    if isinstance(adjacency_matrix, AdjacencyMatrix):
+        return adjacency_matrix.select(buildings_index, services_index)
+    return adjacency_to_csr(adjacency_matrix, buildings_index, services_index)
+
+
+def save_adjacency_matrix(
+    adjacency_matrix: Union[pd.DataFrame, AdjacencyMatrix], path: str, max_distance: Optional[float] = None
+):
+    """Save an adjacency matrix to a directory of .npy arrays which can be loaded memory-mapped.
+
+    Args:
+        adjacency_matrix (pd.DataFrame | AdjacencyMatrix): dense matrix with buildings as index and services as
+            columns, long-format edge table with "building_index", "service_index" and "distance" columns, or
+            an already loaded matrix.
+        path (str): directory to save arrays to, created if missing.
+        max_distance (float, optional): keep only pairs within this distance.
+
+    Raises:
+        AdjacencyMatrixValueError: if labels are neither numbers nor strings.
+    """
+    if isinstance(adjacency_matrix, AdjacencyMatrix):
+        buildings_index, services_index = adjacency_matrix.buildings_index, adjacency_matrix.services_index
+        matrix = adjacency_matrix.matrix
+    else:
+        if set(EDGE_TABLE_COLUMNS).issubset(adjacency_matrix.columns):
+            buildings_index = pd.Index(adjacency_matrix["building_index"].unique())
+            services_index = pd.Index(adjacency_matrix["service_index"].unique())
+        else:
+            buildings_index, services_index = adjacency_matrix.index.astype(int), adjacency_matrix.columns
+        matrix = adjacency_to_csr(adjacency_matrix, buildings_index, services_index)
+    if max_distance is not None:
+        keep = matrix.data <= max_distance
+        row = np.repeat(np.arange(matrix.shape[0]), np.diff(matrix.indptr))[keep]
+        indptr = np.concatenate(([0], np.cumsum(np.bincount(row, minlength=matrix.shape[0]))))
+        matrix = sparse.csr_matrix((matrix.data[keep], matrix.indices[keep], indptr), shape=matrix.shape)
+
+    os.makedirs(path, exist_ok=True)
+    arrays = (matrix.data, matrix.indices, matrix.indptr, _labels_array(buildings_index), _labels_array(services_index))
+    for name, array in zip(_ARRAYS, arrays):
+        np.save(os.path.join(path, f"{name}.npy"), array)
+
+
+def load_adjacency_matrix(path: str, mmap_mode: Optional[str] = "r") -> AdjacencyMatrix:
+    """Load an adjacency matrix saved with `save_adjacency_matrix`.
+
+    Args:
+        path (str): directory with saved arrays.
+        mmap_mode (str, optional): memory-map mode passed to `np.load`, None reads arrays into memory.
+            Defaults to "r".
+
+    Returns:
+        AdjacencyMatrix: matrix which can be passed to `get_service_provision` as is.
+    """
+    data, indices, indptr, buildings_index, services_index = (
+        np.load(os.path.join(path, f"{name}.npy"), mmap_mode=mmap_mode) for name in _ARRAYS
+    )
+    return AdjacencyMatrix(
+        matrix=sparse.csr_matrix(
+            (data, indices, indptr), shape=(len(services_index), len(buildings_index)), copy=False
+        ),
+        buildings_index=pd.Index(buildings_index),
+        services_index=pd.Index(services_index),
+    )
+
+
+def _labels_array(index: pd.Index) -> np.ndarray:
+    """Labels as an array which can be memory-mapped, strings are stored as fixed-width unicode."""
+    values = index.to_numpy()
+    if values.dtype != object:
+        return values
+    if index.inferred_type != "string":
+        raise AdjacencyMatrixValueError(
+            f"only numeric or string labels can be saved, got labels of '{index.inferred_type}' type"
+        )
+    return values.astype(str)
@@ -0,0 +1,193 @@
+import hashlib
+import os
+import shutil
+import tempfile
+from typing import Optional, Tuple, Union
+
+import geopandas as gpd
+import numpy as np
+import pandas as pd
+import shapely
+from loguru import logger
+from scipy import sparse
+
+from .adjacency import AdjacencyMatrix
+
+_FRAMES = ("buildings", "services", "links")
+
+ProvisionResult = Tuple[gpd.GeoDataFrame, gpd.GeoDataFrame, Union[gpd.GeoDataFrame, pd.DataFrame]]
+
+
+class ProvisionCache:
+    """
+    On-disk cache of provision results keyed by fingerprints of the inputs.
+
+    Inputs are fingerprinted by hashing their numeric arrays, indexes and geometry coordinates, so computing a key
+    is much cheaper than the provision itself. Results are stored as (Geo)Parquet files, one directory per key,
+    and the least recently used entries are evicted once the total size exceeds ``max_size``. Requires pyarrow.
+
+    Args:
+        path (str): directory to store results in, created if missing.
+        max_size (int): maximum total size of stored results in bytes. Defaults to 1 GiB.
+
+    Attributes:
+        hits (int): number of lookups which returned a stored result.
+        misses (int): number of lookups which found nothing.
+    """
+
+    def __init__(self, path: str, max_size: int = 2**30):
+        self.path = path
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        os.makedirs(path, exist_ok=True)
+
+    def key(
+        self,
+        demanded_buildings: gpd.GeoDataFrame,
+        adjacency_matrix: Union[pd.DataFrame, AdjacencyMatrix, sparse.spmatrix, sparse.sparray],
+        services: gpd.GeoDataFrame,
+        **params,
+    ) -> str:
+        """Fingerprint provision inputs, see `fingerprint_inputs`."""
+        return fingerprint_inputs(demanded_buildings, adjacency_matrix, services, **params)
+
+    def get(self, key: str) -> Optional[ProvisionResult]:
+        """Load a stored result, None if there is no result for the key."""
+        entry = os.path.join(self.path, key)
+        try:
+            result = tuple(_read_frame(os.path.join(entry, f"{name}.parquet")) for name in _FRAMES)
+            os.utime(entry)
+        except FileNotFoundError:
+            self.misses += 1
+            logger.debug("Provision cache miss for {}", key)
+            return None
+        self.hits += 1
+        logger.debug("Provision cache hit for {}", key)
+        return result
+
+    def put(self, key: str, result: ProvisionResult) -> bool:
+        """Store a result and evict the least recently used entries if the cache grew over ``max_size``.
+
+        A result which can't be stored, e.g. with non-string column labels Parquet does not support or on a full
+        disk, is logged as a warning and skipped, so the calculation it came from is not lost.
+
+        Returns:
+            bool: whether the result is stored.
+        """
+        entry = os.path.join(self.path, key)
+        tmp = tempfile.mkdtemp(prefix=".tmp-", dir=self.path)
+        try:
+            for name, frame in zip(_FRAMES, result):
+                frame.to_parquet(os.path.join(tmp, f"{name}.parquet"))
+            os.rename(tmp, entry)
+        except (OSError, ValueError, TypeError, NotImplementedError) as error:
+            # the entry exists if it was stored concurrently by another process
+            if not os.path.isdir(entry):
+                logger.warning("Provision result for {} was not cached: {}", key, error)
+                return False
+        finally:
+            shutil.rmtree(tmp, ignore_errors=True)
+        self._evict()
+        return True
+
+    def clear(self):
+        """Remove all stored results."""
+        for name in os.listdir(self.path):
+            shutil.rmtree(os.path.join(self.path, name), ignore_errors=True)
+
+    def _evict(self):
+        entries = []
+        for name in os.listdir(self.path):
+            entry = os.path.join(self.path, name)
+            if name.startswith(".") or not os.path.isdir(entry):
+                continue
+            with os.scandir(entry) as files:
+                size = sum(file.stat().st_size for file in files)
+            entries.append((os.stat(entry).st_mtime, size, entry))
+        total = sum(size for _, size, _ in entries)
+        for _, size, entry in sorted(entries):
+            if total <= self.max_size:
+                break
+            logger.debug("Evicting {} from provision cache", os.path.basename(entry))
+            shutil.rmtree(entry, ignore_errors=True)
+            total -= size
+
+
+def fingerprint_inputs(
+    demanded_buildings: gpd.GeoDataFrame,
+    adjacency_matrix: Union[pd.DataFrame, AdjacencyMatrix, sparse.spmatrix, sparse.sparray],
+    services: gpd.GeoDataFrame,
+    **params,
+) -> str:
+    """Fingerprint provision inputs.
+
+    Args:
+        demanded_buildings (gpd.GeoDataFrame): buildings with demands.
+        adjacency_matrix (pd.DataFrame | AdjacencyMatrix | sparse.spmatrix | sparse.sparray): adjacency matrix
+            in any form accepted by `get_service_provision`.
+        services (gpd.GeoDataFrame): services with capacities.
+        **params: other parameters affecting the result, e.g. threshold and calculation type.
+
+    Returns:
+        str: hex digest identifying the inputs.
+    """
+    from . import __version__  # pylint: disable=import-outside-toplevel
+
+    hasher = hashlib.blake2b(digest_size=20)
+    hasher.update(repr((__version__, sorted(params.items()))).encode())
+    _hash_frame(hasher, demanded_buildings)
+    _hash_frame(hasher, services)
+    if isinstance(adjacency_matrix, AdjacencyMatrix):
+        _hash_csr(hasher, adjacency_matrix.matrix)
+        _hash_index(hasher, adjacency_matrix.buildings_index)
+        _hash_index(hasher, adjacency_matrix.services_index)
+    elif sparse.issparse(adjacency_matrix):
+        _hash_csr(hasher, sparse.csr_matrix(adjacency_matrix))
+    else:
+        _hash_frame(hasher, adjacency_matrix)
+    return hasher.hexdigest()
+
+
+def _hash_array(hasher, array: np.ndarray):
+    array = np.ascontiguousarray(array)
+    hasher.update(repr((array.dtype.str, array.shape)).encode())
+    if array.dtype.hasobject:
+        array = pd.util.hash_array(array.ravel())
+    hasher.update(array.data)
+
+
+def _hash_index(hasher, index: pd.Index):
+    hasher.update(repr(index.dtype).encode())
+    _hash_array(hasher, pd.util.hash_pandas_object(index, index=False).to_numpy())
+
+
+def _hash_csr(hasher, matrix: sparse.csr_matrix):
+    hasher.update(repr(matrix.shape).encode())
+    for array in (matrix.data, matrix.indices, matrix.indptr):
+        _hash_array(hasher, array)
+
+
+def _hash_frame(hasher, frame: pd.DataFrame):
+    if isinstance(frame, gpd.GeoDataFrame):
+        geometry = np.asarray(frame.geometry.values)
+        hasher.update(str(frame.crs).encode())
+        _hash_array(hasher, shapely.get_type_id(geometry))
+        _hash_array(hasher, shapely.get_num_coordinates(geometry))
+        _hash_array(hasher, shapely.get_coordinates(geometry))
+        frame = pd.DataFrame(frame.drop(columns=frame.geometry.name))
+    hasher.update(repr([(column, str(dtype)) for column, dtype in frame.dtypes.items()]).encode())
+    _hash_index(hasher, frame.index)
+    if all(dtype.kind in "biuf" for dtype in frame.dtypes):
+        _hash_array(hasher, frame.to_numpy())
+    else:
+        for column in frame.columns:
+            _hash_array(hasher, pd.util.hash_pandas_object(frame[column], index=False).to_numpy())
+
+
+def _read_frame(path: str) -> Union[gpd.GeoDataFrame, pd.DataFrame]:
+    import pyarrow.parquet as pq  # pylint: disable=import-outside-toplevel
+
+    if b"geo" in (pq.read_schema(path).metadata or {}):
+        return gpd.read_parquet(path)
+    return pd.read_parquet(path)
@@ -0,0 +1,110 @@
+import sys
+import time
+from typing import Callable, List, Optional
+
+from loguru import logger
+
+from .provisio_exceptions import ProvisionCancelledError
+
+try:
+    import resource
+except ImportError:  # pragma: no cover, not available on Windows
+    resource = None
+
+ProvisionCallback = Callable[[str, dict], None]
+
+
+def max_rss_mb() -> Optional[float]:
+    """Peak resident memory of the current process in megabytes, None where it can't be measured."""
+    if resource is None:
+        return None
+    max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return max_rss / 2**20 if sys.platform == "darwin" else max_rss / 2**10
+
+
+def notify(callback: Optional[ProvisionCallback], event: str, payload: dict):
+    """Log an instrumentation event and pass it to the callback, if any."""
+    logger.debug("{}: {}", event, payload)
+    if callback is not None:
+        callback(event, payload)
+
+
+class StageTimer:
+    """Context manager sending a "stage" event with wall time and peak memory when the stage is done."""
+
+    def __init__(self, callback: Optional[ProvisionCallback], stage: str):
+        self.callback = callback
+        self.stage = stage
+        self.start = None
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        if exc_type is None:
+            notify(
+                self.callback,
+                "stage",
+                {"stage": self.stage, "wall_time_s": time.perf_counter() - self.start, "max_rss_mb": max_rss_mb()},
+            )
+
+
+class ProvisionMetrics:
+    """
+    Callback collecting instrumentation events of a provision run.
+
+    "stage" events carry stage name, its wall time and peak memory of the process. "iteration" events
+    are sent by the threshold expansion loop of provision engines and carry the engine name, iteration number,
+    selection range, numbers of services and buildings with units left, numbers of reachable and in-range pairs
+    and the amount of flows assigned on the iteration. "tile" events are sent by tiled solve when a tile is done.
+
+    Args:
+        callback (ProvisionCallback, optional): callback to forward every event to, e.g. an exporter to monitoring.
+    """
+
+    def __init__(self, callback: Optional[ProvisionCallback] = None):
+        self.callback = callback
+        self.stages: List[dict] = []
+        self.iterations: List[dict] = []
+        self.tiles: List[dict] = []
+
+    def __call__(self, event: str, payload: dict):
+        if event == "stage":
+            self.stages.append(payload)
+        elif event == "iteration":
+            self.iterations.append(payload)
+        elif event == "tile":
+            self.tiles.append(payload)
+        if self.callback is not None:
+            self.callback(event, payload)
+
+
+class StallGuard:
+    """
+    Callback cancelling a provision run when the threshold expansion loop stops making progress.
+
+    Args:
+        max_stalled_iterations (int): number of iterations in a row without assigned flows to tolerate.
+        callback (ProvisionCallback, optional): callback to forward every event to.
+
+    Raises:
+        ProvisionCancelledError: when the limit of stalled iterations is exceeded.
+    """
+
+    def __init__(self, max_stalled_iterations: int = 3, callback: Optional[ProvisionCallback] = None):
+        self.max_stalled_iterations = max_stalled_iterations
+        self.callback = callback
+        self.stalled = 0
+
+    def __call__(self, event: str, payload: dict):
+        if self.callback is not None:
+            self.callback(event, payload)
+        if event != "iteration":
+            return
+        self.stalled = self.stalled + 1 if payload["flows_assigned"] == 0 else 0
+        if self.stalled > self.max_stalled_iterations:
+            raise ProvisionCancelledError(
+                f"{self.stalled} iterations of {payload['engine']} engine in a row assigned no flows, "
+                f"selection range reached {payload['threshold']}"
+            )
@@ -0,0 +1,268 @@
+import asyncio
+import inspect
+import itertools
+import multiprocessing
+import threading
+from concurrent.futures import Future, ProcessPoolExecutor
+from typing import Dict, Optional, Set
+
+import geopandas as gpd
+import numpy as np
+from loguru import logger
+
+from .cache import ProvisionResult, fingerprint_inputs
+from .instrumentation import ProvisionCallback
+from .provisio import get_service_provision
+from .provisio_exceptions import ProvisionCancelledError
+
+# parameters of `get_service_provision` which do not change its result
+_RUN_PARAMS = ("demanded_buildings", "adjacency_matrix", "services", "max_workers", "callback", "cache", "inplace")
+
+# state of job worker processes, set once by `_init_job_worker`
+_worker_events = None  # pylint: disable=invalid-name
+_worker_cancelled = None  # pylint: disable=invalid-name
+
+
+def _init_job_worker(events, cancelled):
+    global _worker_events, _worker_cancelled  # pylint: disable=global-statement
+    _worker_events = events
+    _worker_cancelled = cancelled
+
+
+def _result_params(threshold: int, params: dict) -> dict:
+    """Parameters of `get_service_provision` which change its result, defaults included, so calls passing
+    a default value explicitly get the same fingerprint as calls omitting it."""
+    arguments = inspect.signature(get_service_provision).bind(None, None, None, threshold, **params)
+    arguments.apply_defaults()
+    return {name: value for name, value in arguments.arguments.items() if name not in _RUN_PARAMS}
+
+
+def _job_worker(job_id: int, demanded_buildings, adjacency_matrix, services, threshold, params: dict):
+    def forward(event: str, payload: dict):
+        if job_id in _worker_cancelled:
+            raise ProvisionCancelledError(f"Provision job {job_id} was cancelled")
+        _worker_events.put((job_id, event, payload))
+
+    forward("started", {})
+    return get_service_provision(demanded_buildings, adjacency_matrix, services, threshold, callback=forward, **params)
+
+
+class _Computation:
+    def __init__(self, job_id: int, key: Optional[str], future: Future):
+        self.job_id = job_id
+        self.key = key
+        self.future = future
+        self.handles: Set["ProvisionJob"] = set()
+        self.progress: dict = {}
+
+
+class ProvisionJob:
+    """
+    Handle of a provision calculation submitted to `ProvisionJobQueue`, await it to get the result.
+
+    Handles of identical submissions share one calculation, cancelling a handle cancels the calculation
+    only when no other handle waits for it.
+
+    Attributes:
+        key (str | None): fingerprint of the inputs, None if the submission is not coalesced.
+        progress (dict): latest progress of the calculation: "running" once a worker took it, "stage" of the last
+            finished stage and "iteration", the payload of the last event of the threshold expansion loop.
+    """
+
+    def __init__(self, queue: "ProvisionJobQueue", computation: _Computation, callback: Optional[ProvisionCallback]):
+        self._queue = queue
+        self._computation = computation
+        self._callback = callback
+        self._future = asyncio.get_running_loop().create_future()
+        self.key = computation.key
+
+    @property
+    def progress(self) -> dict:
+        return dict(self._computation.progress)
+
+    def done(self) -> bool:
+        """Whether the result is ready, the calculation failed or the job was cancelled."""
+        return self._future.done()
+
+    def cancelled(self) -> bool:
+        return self._future.cancelled()
+
+    def cancel(self) -> bool:
+        """Cancel the job, False if it is already done."""
+        if self._future.done():
+            return False
+        self._future.cancel()
+        self._queue._detach(self)  # pylint: disable=protected-access
+        return True
+
+    async def result(self) -> ProvisionResult:
+        """Wait for the calculation and return provision buildings, services and links."""
+        return await asyncio.shield(self._future)
+
+    def __await__(self):
+        return self.result().__await__()
+
+
+class ProvisionJobQueue:
+    """
+    Asyncio front end running `get_service_provision` in a bounded pool of processes.
+
+    Submitting returns immediately with a `ProvisionJob` handle, so the event loop keeps serving while
+    calculations run. Identical submissions are coalesced by fingerprints of their inputs while the first one
+    is pending or running. Progress events of the threshold expansion loop are passed to the submission
+    callbacks on the event loop. Inputs and results are pickled to and from worker processes.
+
+    Args:
+        max_workers (int, optional): number of calculations running at once, defaults to the number of CPUs.
+        coalesce (bool): share one calculation between identical submissions. Submissions with
+            a generator `seed` are never coalesced.
+    """
+
+    def __init__(self, max_workers: Optional[int] = None, coalesce: bool = True):
+        self.max_workers = max_workers
+        self.coalesce = coalesce
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._manager = None
+        self._pool: Optional[ProcessPoolExecutor] = None
+        self._events = None
+        self._cancelled = None
+        self._reader: Optional[threading.Thread] = None
+        self._ids = itertools.count()
+        self._running: Dict[int, _Computation] = {}
+        self._by_key: Dict[str, _Computation] = {}
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc_val, exc_tb):
+        await self.close(cancel=exc_type is not None)
+
+    def _start(self):
+        self._loop = asyncio.get_running_loop()
+        self._manager = multiprocessing.Manager()
+        self._events = self._manager.Queue()
+        self._cancelled = self._manager.dict()
+        self._pool = ProcessPoolExecutor(
+            max_workers=self.max_workers, initializer=_init_job_worker, initargs=(self._events, self._cancelled)
+        )
+        self._reader = threading.Thread(target=self._read_events, name="provision-job-events", daemon=True)
+        self._reader.start()
+
+    async def submit(
+        self,
+        demanded_buildings: gpd.GeoDataFrame,
+        adjacency_matrix,
+        services: gpd.GeoDataFrame,
+        threshold: int,
+        callback: Optional[ProvisionCallback] = None,
+        **params,
+    ) -> ProvisionJob:
+        """Submit a provision calculation.
+
+        Args:
+            demanded_buildings (gpd.GeoDataFrame): buildings with "demand" column.
+            adjacency_matrix: adjacency matrix in any form accepted by `get_service_provision`.
+            services (gpd.GeoDataFrame): services with "capacity" column.
+            threshold (int): threshold value.
+            callback (Callable[[str, dict], None], optional): receives "started", stage, iteration and tile events
+                of the calculation, called on the event loop.
+            **params: other parameters of `get_service_provision`, except `links_chunk_size`.
+
+        Returns:
+            ProvisionJob: handle of the calculation.
+        """
+        if params.get("links_chunk_size") is not None:
+            raise ValueError("Chunked links can't be returned from a worker process, use write_links on the result")
+        if self._pool is None:
+            self._start()
+        key = None
+        if self.coalesce and not isinstance(params.get("seed"), np.random.Generator):
+            result_params = _result_params(threshold, params)
+            key = await self._loop.run_in_executor(
+                None, lambda: fingerprint_inputs(demanded_buildings, adjacency_matrix, services, **result_params)
+            )
+        computation = self._by_key.get(key) if key is not None else None
+        if computation is None:
+            job_id = next(self._ids)
+            future = self._pool.submit(
+                _job_worker, job_id, demanded_buildings, adjacency_matrix, services, threshold, params
+            )
+            computation = _Computation(job_id, key, future)
+            self._running[job_id] = computation
+            if key is not None:
+                self._by_key[key] = computation
+            future.add_done_callback(lambda _: self._loop.call_soon_threadsafe(self._finish, computation))
+        else:
+            logger.debug("Coalescing provision submission with job {}", computation.job_id)
+        job = ProvisionJob(self, computation, callback)
+        computation.handles.add(job)
+        return job
+
+    def _detach(self, job: ProvisionJob):
+        computation = job._computation  # pylint: disable=protected-access
+        computation.handles.discard(job)
+        if computation.handles or computation.future.done():
+            return
+        if computation.key is not None:
+            self._by_key.pop(computation.key, None)
+        if not computation.future.cancel():
+            logger.debug("Cancelling running provision job {}", computation.job_id)
+            self._cancelled[computation.job_id] = True
+
+    def _finish(self, computation: _Computation):
+        self._running.pop(computation.job_id, None)
+        if self._by_key.get(computation.key) is computation:
+            del self._by_key[computation.key]
+        if computation.future.cancelled():
+            return
+        self._cancelled.pop(computation.job_id, None)
+        error = computation.future.exception()
+        for job in computation.handles:
+            if job.done():
+                continue
+            if error is not None:
+                job._future.set_exception(error)  # pylint: disable=protected-access
+            else:
+                job._future.set_result(computation.future.result())  # pylint: disable=protected-access
+
+    def _read_events(self):
+        while True:
+            item = self._events.get()
+            if item is None:
+                return
+            self._loop.call_soon_threadsafe(self._dispatch, *item)
+
+    def _dispatch(self, job_id: int, event: str, payload: dict):
+        computation = self._running.get(job_id)
+        if computation is None:
+            return
+        if event == "started":
+            computation.progress["running"] = True
+        elif event == "stage":
+            computation.progress["stage"] = payload["stage"]
+        elif event == "iteration":
+            computation.progress["iteration"] = payload
+        for job in list(computation.handles):
+            if job._callback is not None:  # pylint: disable=protected-access
+                try:
+                    job._callback(event, payload)  # pylint: disable=protected-access
+                except Exception:  # pylint: disable=broad-except
+                    logger.exception("Provision job callback failed")
+
+    async def close(self, cancel: bool = False):
+        """Wait for submitted calculations and stop worker processes.
+
+        Args:
+            cancel (bool): cancel all submitted jobs instead of waiting for them.
+        """
+        if self._pool is None:
+            return
+        if cancel:
+            for computation in list(self._running.values()):
+                for job in list(computation.handles):
+                    job.cancel()
+        await self._loop.run_in_executor(None, self._pool.shutdown)
+        self._events.put(None)
+        await self._loop.run_in_executor(None, self._reader.join)
+        self._manager.shutdown()
+        self._pool = None
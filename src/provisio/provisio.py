@@ -1,9 +1,23 @@
-from typing import Tuple
+import os
+import tempfile
+from concurrent.futures import ProcessPoolExecutor
+from typing import Callable, Dict, Iterator, Mapping, Optional, Tuple, Union
 
 import geopandas as gpd
+import numpy as np
 import pandas as pd
+from scipy import sparse
 
+from .adjacency import AdjacencyMatrix, select_adjacency_matrix, sparse_to_adjacency_matrix
+from .cache import ProvisionCache
+from .instrumentation import ProvisionCallback, StageTimer, notify
+from .provisio_exceptions import CapacityKeyError, DemandKeyError
 from .provision_logic import CityProvision
+from .utils import catchment_aggregates
+
+# state of batch worker processes, set once by `_init_provision_worker`
+_worker_buildings: Optional[gpd.GeoDataFrame] = None  # pylint: disable=invalid-name
+_worker_matrix: Optional[sparse.csr_matrix] = None  # pylint: disable=invalid-name
 
 
 def demands_from_buildings_by_normative(buildings_with_people: gpd.GeoDataFrame, normative: float) -> gpd.GeoDataFrame:
@@ -23,28 +37,336 @@ def demands_from_buildings_by_normative(buildings_with_people: gpd.GeoDataFrame,
 
 def get_service_provision(
     demanded_buildings: gpd.GeoDataFrame,
-    adjacency_matrix: pd.DataFrame,
+    adjacency_matrix: Union[pd.DataFrame, AdjacencyMatrix, sparse.spmatrix, sparse.sparray],
     services: gpd.GeoDataFrame,
     threshold: int,
     calculation_type: str = "gravity",
-) -> Tuple[gpd.GeoDataFrame, gpd.GeoDataFrame, gpd.GeoDataFrame]:
+    links_geometry: bool = True,
+    tile_size: Optional[float] = None,
+    max_workers: Optional[int] = None,
+    callback: Optional[ProvisionCallback] = None,
+    cache: Optional[ProvisionCache] = None,
+    seed: Union[int, np.random.Generator] = 0,
+    round_flows: bool = False,
+    inplace: bool = False,
+    links_chunk_size: Optional[int] = None,
+) -> Tuple[
+    gpd.GeoDataFrame,
+    gpd.GeoDataFrame,
+    Union[gpd.GeoDataFrame, pd.DataFrame, Iterator[Union[gpd.GeoDataFrame, pd.DataFrame]]],
+]:
     """Calculate load from buildings with demands on the given services using the distances matrix between them.
 
     Args:
         services (gpd.GeoDataFrame): GeoDataFrame of services
-        adjacency_matrix (pd.DataFrame): DataFrame representing the adjacency matrix
+        adjacency_matrix (pd.DataFrame | AdjacencyMatrix | sparse.spmatrix | sparse.sparray): DataFrame representing
+            the adjacency matrix with buildings as index and services as columns, a long-format edge table with
+            "building_index", "service_index" and "distance" columns, a matrix loaded with `load_adjacency_matrix`,
+            or a SciPy sparse matrix with rows matching `demanded_buildings` and columns matching `services`.
+            Sparse inputs should only store pairs under some max distance, memory then scales with the number of
+            reachable pairs.
         demanded_buildings (gpd.GeoDataFrame): GeoDataFrame of demanded buildings
         threshold (int): Threshold value
-        calculation_type (str): Calculation type for provision, might be "gravity" or "linear"
+        calculation_type (str): Calculation type for provision, might be "gravity", "gravity_expected" or "linear".
+            "gravity_expected" distributes fractional expected flows of the gravity model, its cost does not grow
+            with capacity
+        links_geometry (bool): Build link lines geometry, if False links are returned as a plain DataFrame
+        tile_size (float, optional): Split buildings into square tiles of this size in CRS units and solve every tile
+            separately, capacity shared across tile borders is reconciled afterwards. Use it for cities too large
+            for one problem, solver memory is bounded by a tile while the matrix and flows stay city-sized
+        max_workers (int, optional): Number of processes to solve tiles with
+        callback (Callable[[str, dict], None], optional): Receives stage timings and threshold loop progress
+            events, see `ProvisionMetrics` and `StallGuard`. Raise from it to cancel the calculation
+        cache (ProvisionCache, optional): Return the stored result if the same inputs were already calculated,
+            store the result otherwise. Lookups are reported to `callback` as "cache" events. Not used with
+            a generator `seed`
+        seed (int | np.random.Generator): Seed or generator for the gravity sampling, an int seed reproduces
+            the result regardless of rows order and `max_workers`
+        round_flows (bool): Round "gravity_expected" flows to whole units without exceeding capacity and demand
+        inplace (bool): Add result columns to the passed GeoDataFrames instead of their copies, saves memory
+            when the originals are not needed. Cached results are returned as new GeoDataFrames
+        links_chunk_size (int, optional): Return links as an iterator of chunks derived from at most this many
+            reachable pairs each, instead of one GeoDataFrame, pass it to `write_links` to save links with bounded
+            memory. Not used with `cache`
     Returns:
-        Tuple[gpd.GeoDataFrame, gpd.GeoDataFrame, gpd.GeoDataFrame]: Tuple of GeoDataFrames representing provision
-        buildings, provision services, and provision links
+        Tuple[gpd.GeoDataFrame, gpd.GeoDataFrame, gpd.GeoDataFrame | pd.DataFrame | Iterator]: Tuple of
+        GeoDataFrames representing provision buildings, provision services, and provision links
     """
-    provision_buildings, provision_services, provision_links = CityProvision(
+    if isinstance(seed, np.random.Generator) or links_chunk_size is not None:
+        cache = None
+    if cache is not None:
+        with StageTimer(callback, "fingerprint"):
+            key = cache.key(
+                demanded_buildings,
+                adjacency_matrix,
+                services,
+                threshold=threshold,
+                calculation_type=calculation_type,
+                links_geometry=links_geometry,
+                tile_size=tile_size,
+                seed=seed,
+                round_flows=round_flows,
+            )
+        cached = cache.get(key)
+        notify(callback, "cache", {"key": key, "hit": cached is not None})
+        if cached is not None:
+            return cached
+
+    city_provision = CityProvision(
         services=services,
         demanded_buildings=demanded_buildings,
         adjacency_matrix=adjacency_matrix,
         threshold=threshold,
         calculation_type=calculation_type,
-    ).get_provisions()
+        links_geometry=links_geometry,
+        tile_size=tile_size,
+        max_workers=max_workers,
+        callback=callback,
+        seed=seed,
+        round_flows=round_flows,
+        inplace=inplace,
+    )
+    if links_chunk_size is not None:
+        return city_provision.iter_provisions(links_chunk_size)
+    provision_buildings, provision_services, provision_links = city_provision.get_provisions()
+    if cache is not None:
+        cache.put(key, (provision_buildings, provision_services, provision_links))
     return provision_buildings, provision_services, provision_links
+
+
+def get_service_accessibility(
+    demanded_buildings: gpd.GeoDataFrame,
+    adjacency_matrix: Union[pd.DataFrame, AdjacencyMatrix, sparse.spmatrix, sparse.sparray],
+    services: gpd.GeoDataFrame,
+    threshold: float,
+    decay: Optional[Callable[[np.ndarray], np.ndarray]] = None,
+) -> Tuple[gpd.GeoDataFrame, gpd.GeoDataFrame]:
+    """Calculate catchment accessibility of services without assigning flows (two-step floating catchment area).
+
+    Every service gets the demand within threshold and its capacity to demand ratio, every building gets
+    the capacity within threshold and the sum of ratios of services it reaches. This takes a single pass over
+    the reachable pairs, so it is much cheaper than `get_service_provision` and works for matrices too large
+    for flow assignment.
+
+    Args:
+        demanded_buildings (gpd.GeoDataFrame): buildings with "demand" column.
+        adjacency_matrix (pd.DataFrame | AdjacencyMatrix | sparse.spmatrix | sparse.sparray): adjacency matrix
+            in any form accepted by `get_service_provision`.
+        services (gpd.GeoDataFrame): services with "capacity" column.
+        threshold (float): catchment size in adjacency matrix units.
+        decay (Callable[[np.ndarray], np.ndarray], optional): distance decay weights of pairs within threshold,
+            e.g. ``lambda d: np.exp(-d / 10)``. Defaults to None, all pairs within threshold weigh 1.
+
+    Returns:
+        Tuple[gpd.GeoDataFrame, gpd.GeoDataFrame]: buildings with "capacity_within" and "accessibility" columns and
+        services with "demand_within" and "supply_ratio" columns.
+    """
+    if "demand" not in demanded_buildings.columns:
+        raise DemandKeyError
+    if "capacity" not in services.columns:
+        raise CapacityKeyError
+    if sparse.issparse(adjacency_matrix):
+        adjacency_matrix = sparse_to_adjacency_matrix(adjacency_matrix, demanded_buildings.index, services.index)
+    matrix = select_adjacency_matrix(adjacency_matrix, demanded_buildings.index.astype(int), services.index)
+    demand_within, supply_ratio, capacity_within, accessibility = catchment_aggregates(
+        matrix,
+        demanded_buildings["demand"].fillna(0).to_numpy(float),
+        services["capacity"].fillna(0).to_numpy(float),
+        threshold,
+        decay,
+    )
+    buildings = demanded_buildings.copy()
+    buildings["capacity_within"] = capacity_within
+    buildings["accessibility"] = accessibility
+    services = services.copy()
+    services["demand_within"] = demand_within
+    services["supply_ratio"] = supply_ratio
+    return buildings, services
+
+
+def get_service_provision_batch(
+    buildings_with_people: gpd.GeoDataFrame,
+    adjacency_matrix: Union[pd.DataFrame, AdjacencyMatrix, sparse.spmatrix, sparse.sparray],
+    services: Mapping[str, Tuple[gpd.GeoDataFrame, float, int]],
+    calculation_type: str = "gravity",
+    links_geometry: bool = True,
+    max_workers: Optional[int] = None,
+    seed: int = 0,
+) -> Dict[str, Tuple[gpd.GeoDataFrame, gpd.GeoDataFrame, Union[gpd.GeoDataFrame, pd.DataFrame]]]:
+    """Calculate provision for several service types against the same buildings and adjacency matrix in parallel.
+
+    The adjacency matrix is converted once into a sparse services x buildings matrix and shared with the worker
+    processes as memory-mapped arrays, every worker receives the buildings once and derives the demands of
+    each service type with `demands_from_buildings_by_normative`.
+
+    Args:
+        buildings_with_people (gpd.GeoDataFrame): buildings with "population" column.
+        adjacency_matrix (pd.DataFrame | AdjacencyMatrix | sparse.spmatrix | sparse.sparray): adjacency matrix
+            in any form accepted by `get_service_provision`. Columns of a SciPy sparse matrix must follow
+            the services of all types concatenated in the mapping order, other forms are selected by services
+            index labels, which then must be unique across all types.
+        services (Mapping[str, Tuple[gpd.GeoDataFrame, float, int]]): mapping of service type to its services,
+            normative and threshold.
+        calculation_type (str): Calculation type for provision, might be "gravity", "gravity_expected" or "linear"
+        links_geometry (bool): Build link lines geometry, if False links are returned as a plain DataFrame
+        max_workers (int, optional): number of worker processes, defaults to the number of processors.
+        seed (int): seed for the gravity sampling, every service type gets the same result as with
+            `get_service_provision` and this seed.
+
+    Returns:
+        Dict[str, Tuple[gpd.GeoDataFrame, gpd.GeoDataFrame, gpd.GeoDataFrame | pd.DataFrame]]: provision buildings,
+        services and links for every service type. Provision buildings only keep "population" and geometry of the
+        source columns, join them back by index if needed.
+    """
+    offsets = np.cumsum([0, *(len(service_gdf) for service_gdf, _, _ in services.values())])
+    if sparse.issparse(adjacency_matrix):
+        # columns are matched by position, so service types sharing index labels keep their own columns
+        matrix = sparse_to_adjacency_matrix(
+            adjacency_matrix, buildings_with_people.index, pd.RangeIndex(offsets[-1])
+        ).matrix
+    else:
+        indexes = [service_gdf.index for service_gdf, _, _ in services.values()]
+        services_index = indexes[0].append(indexes[1:])
+        if not services_index.is_unique:
+            raise ValueError(
+                "Services index labels must be unique across all service types to select them from a labelled "
+                "adjacency matrix, pass a SciPy sparse matrix to match services by position"
+            )
+        matrix = select_adjacency_matrix(adjacency_matrix, buildings_with_people.index.astype(int), services_index)
+    buildings = buildings_with_people[["population", buildings_with_people.geometry.name]]
+
+    with tempfile.TemporaryDirectory() as matrix_dir:
+        for name in ("data", "indices", "indptr"):
+            np.save(os.path.join(matrix_dir, f"{name}.npy"), getattr(matrix, name))
+        with ProcessPoolExecutor(
+            max_workers=max_workers,
+            initializer=_init_provision_worker,
+            initargs=(buildings, matrix_dir, matrix.shape),
+        ) as executor:
+            futures = {
+                service_type: executor.submit(
+                    _provision_worker,
+                    service_gdf,
+                    np.arange(offset, offset + len(service_gdf)),
+                    normative,
+                    threshold,
+                    calculation_type,
+                    links_geometry,
+                    seed,
+                )
+                for offset, (service_type, (service_gdf, normative, threshold)) in zip(offsets, services.items())
+            }
+            return {service_type: future.result() for service_type, future in futures.items()}
+
+
+def get_service_provision_joint(
+    demanded_buildings: gpd.GeoDataFrame,
+    adjacency_matrix: Union[pd.DataFrame, AdjacencyMatrix, sparse.spmatrix, sparse.sparray],
+    services: Mapping[str, Tuple[gpd.GeoDataFrame, float]],
+    threshold: int,
+    calculation_type: str = "gravity",
+    links_geometry: bool = True,
+    callback: Optional[ProvisionCallback] = None,
+    seed: Union[int, np.random.Generator] = 0,
+) -> Tuple[gpd.GeoDataFrame, Dict[str, gpd.GeoDataFrame], Union[gpd.GeoDataFrame, pd.DataFrame]]:
+    """Calculate provision of one demand shared by several service types in a single solve.
+
+    Capacity of every type is converted into demand units with its substitution weight, e.g. with a weight of 0.5
+    one unit of capacity serves half a unit of demand. All services then compete for the same buildings,
+    so validation, matrix filtering and the threshold loop run once for all types.
+
+    Args:
+        demanded_buildings (gpd.GeoDataFrame): buildings with "demand" column.
+        adjacency_matrix (pd.DataFrame | AdjacencyMatrix | sparse.spmatrix | sparse.sparray): adjacency matrix
+            in any form accepted by `get_service_provision`. Columns of a SciPy sparse matrix must follow
+            the services of all types concatenated in the mapping order.
+        services (Mapping[str, Tuple[gpd.GeoDataFrame, float]]): mapping of service type to its services and
+            substitution weight. Services index labels must be unique across all types.
+        threshold (int): Threshold value
+        calculation_type (str): Calculation type for provision, might be "gravity", "gravity_expected" or "linear"
+        links_geometry (bool): Build link lines geometry, if False links are returned as a plain DataFrame
+        callback (Callable[[str, dict], None], optional): Receives stage timings and threshold loop progress events
+        seed (int | np.random.Generator): Seed or generator for the gravity sampling
+
+    Returns:
+        Tuple[gpd.GeoDataFrame, Dict[str, gpd.GeoDataFrame], gpd.GeoDataFrame | pd.DataFrame]: provision buildings,
+        provision services of every type with capacity columns in their own units, and links with "service_type"
+        column and demand in demand units.
+    """
+    joint_services, service_types = _joint_services(services)
+    provision_buildings, provision_services, provision_links = CityProvision(
+        services=joint_services,
+        demanded_buildings=demanded_buildings,
+        adjacency_matrix=adjacency_matrix,
+        threshold=threshold,
+        calculation_type=calculation_type,
+        links_geometry=links_geometry,
+        callback=callback,
+        seed=seed,
+    ).get_provisions()
+
+    provision_links.insert(3, "service_type", service_types.reindex(provision_links["service_index"]).to_numpy())
+    return provision_buildings, _split_joint_services(provision_services, services, service_types), provision_links
+
+
+def _joint_services(services: Mapping[str, Tuple[gpd.GeoDataFrame, float]]) -> Tuple[gpd.GeoDataFrame, pd.Series]:
+    """Services of all types with capacity in demand units and the type of every service."""
+    frames = []
+    for service_type, (service_gdf, weight) in services.items():
+        if not weight > 0:
+            raise ValueError(f"Substitution weight of '{service_type}' services must be positive, got {weight}")
+        frame = service_gdf.copy(deep=False)
+        frame["capacity"] = service_gdf["capacity"] * weight
+        frames.append(frame)
+    joint_services = pd.concat(frames)
+    if not joint_services.index.is_unique:
+        raise ValueError("Services index labels must be unique across all service types")
+    service_types = pd.Series(
+        np.repeat(list(services), [len(frame) for frame in frames]), index=joint_services.index, name="service_type"
+    )
+    return joint_services, service_types
+
+
+def _split_joint_services(
+    provision_services: gpd.GeoDataFrame,
+    services: Mapping[str, Tuple[gpd.GeoDataFrame, float]],
+    service_types: pd.Series,
+) -> Dict[str, gpd.GeoDataFrame]:
+    """Provision services of every type with capacity columns converted back into their own units."""
+    types_services = {}
+    result_columns = ["capacity_left", "carried_capacity_within", "carried_capacity_without", "service_load"]
+    for service_type, (service_gdf, weight) in services.items():
+        type_services = provision_services[(service_types == service_type).reindex(provision_services.index)]
+        type_services = type_services[[*service_gdf.columns, *result_columns]]
+        type_services["capacity"] = service_gdf["capacity"].reindex(type_services.index)
+        for column in result_columns:
+            type_services[column] = type_services[column] / weight
+        types_services[service_type] = type_services
+    return types_services
+
+
+def _init_provision_worker(buildings: gpd.GeoDataFrame, matrix_dir: str, shape: Tuple[int, int]):
+    global _worker_buildings, _worker_matrix  # pylint: disable=global-statement
+    _worker_buildings = buildings
+    arrays = (np.load(os.path.join(matrix_dir, f"{name}.npy"), mmap_mode="r") for name in ("data", "indices", "indptr"))
+    _worker_matrix = sparse.csr_matrix(tuple(arrays), shape=shape, copy=False)
+
+
+def _provision_worker(
+    services: gpd.GeoDataFrame,
+    positions: np.ndarray,
+    normative: float,
+    threshold: int,
+    calculation_type: str,
+    links_geometry: bool,
+    seed: int,
+):
+    return CityProvision(
+        services=services,
+        demanded_buildings=demands_from_buildings_by_normative(_worker_buildings, normative),
+        adjacency_matrix=_worker_matrix[positions].transpose(),
+        threshold=threshold,
+        calculation_type=calculation_type,
+        links_geometry=links_geometry,
+        seed=seed,
+    ).get_provisions()
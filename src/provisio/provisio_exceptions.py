@@ -57,3 +57,32 @@ class DemandValueError(ValueError):
         if self.message:
             return "DemandValueError, {0} ".format(self.message)
         return "Column 'demand' in 'demanded_buildings' GeoDataFrame  has no valid value."
+
+
+class AdjacencyMatrixValueError(ValueError):
+    def __init__(self, *args):
+        if args:
+            self.message = args[0]
+        else:
+            self.message = None
+
+    def __str__(self):
+        if self.message:
+            return "AdjacencyMatrixValueError, {0} ".format(self.message)
+        return (
+            "Sparse 'adjacency_matrix' shape does not match the provided GeoDataFrames. Rows must correspond to "
+            "'demanded_buildings' and columns to 'services', in the order they are passed."
+        )
+
+
+class ProvisionCancelledError(RuntimeError):
+    def __init__(self, *args):
+        if args:
+            self.message = args[0]
+        else:
+            self.message = None
+
+    def __str__(self):
+        if self.message:
+            return "ProvisionCancelledError, {0} ".format(self.message)
+        return "Provision calculation was cancelled by callback."
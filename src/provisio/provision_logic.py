@@ -1,17 +1,24 @@
 # pylint: disable=singleton-comparison
-from typing import Literal, Tuple
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, as_completed, wait
+from typing import Callable, Iterable, Iterator, Literal, Optional, Tuple, Union
 
 import geopandas as gpd
 import numpy as np
 import pandas as pd
-import pulp
 import pydantic
 from loguru import logger
 from pydantic import BaseModel, InstanceOf, field_validator, model_validator
+from scipy import sparse
 
+from .adjacency import AdjacencyMatrix, select_adjacency_matrix, sparse_to_adjacency_matrix
+from .instrumentation import ProvisionCallback, StageTimer, notify
 from .provisio_exceptions import *
+from .tiling import leftover_pairs, order_by_tiles, tiles_capacity, tiles_seeds
 from .utils import (
     additional_options,
+    centroid_coords,
+    csr_rows_positions,
+    iter_provision_links,
     provision_matrix_transform,
 )
 
@@ -23,10 +30,35 @@ class CityProvision(BaseModel):
     Args:
         services (InstanceOf[gpd.GeoDataFrame]): GeoDataFrame representing the services available in the city.
         demanded_buildings (InstanceOf[gpd.GeoDataFrame]): GeoDataFrame representing the buildings with demands for services.
-        adjacency_matrix (InstanceOf[pd.DataFrame]): DataFrame representing the adjacency matrix between buildings.
+        adjacency_matrix (InstanceOf[pd.DataFrame]): DataFrame representing the adjacency matrix between buildings
+            and services, or a long-format edge table with "building_index", "service_index" and "distance" columns.
+            A SciPy sparse matrix with rows matching 'demanded_buildings' and columns matching 'services' is accepted
+            as well, only its stored entries are considered reachable. An AdjacencyMatrix loaded with
+            `load_adjacency_matrix` is used without copying when it matches 'demanded_buildings' and 'services'.
         threshold (int): Threshold value for the provision calculations.
         user_selection_zone (Optional[dict], optional): User selection zone. Defaults to None.
-        calculation_type (str, optional): Type of calculation ("gravity" or "linear"). Defaults to "gravity".
+        calculation_type (str, optional): Type of calculation ("gravity", "gravity_expected" or "linear").
+            "gravity_expected" distributes fractional expected values of the gravity model instead of sampling it.
+            Defaults to "gravity".
+        links_geometry (bool, optional): Build link lines between buildings and services centroids. If False, links
+            are returned as a plain DataFrame. Defaults to True.
+        tile_size (float, optional): Size of square tiles in CRS units to split buildings into by their centroids.
+            Every tile is solved as a separate problem, so solver memory is bounded by tile size, flows are still
+            kept for all pairs of the city. Defaults to None, the whole city is solved at once.
+        max_workers (int, optional): Number of processes to solve tiles with. Defaults to None, tiles are solved
+            one by one in the current process.
+        callback (Callable[[str, dict], None], optional): Instrumentation callback, receives "stage" events with
+            wall time and peak memory of validation, solve and output stages, "iteration" events of the threshold
+            expansion loop and "tile" events of tiled solve. Iterations of tiles solved in other processes are not
+            reported. Raising from the callback, e.g. `ProvisionCancelledError`, cancels the run. Defaults to None.
+        inplace (bool, optional): Add result columns to the passed GeoDataFrames instead of their copies, they are
+            returned as is if no rows are dropped. Defaults to False, inputs are left untouched. Copies share shapely
+            geometries with the inputs, only columns and the array of geometry references are copied.
+        round_flows (bool, optional): Round "gravity_expected" flows to whole units without exceeding capacity
+            and demand. Defaults to False.
+        seed (int | np.random.Generator): Seed or generator for the gravity sampling. Rows are solved in the order
+            of their index labels and tiles get their own streams spawned from the seed, so an int seed reproduces
+            the result regardless of rows order or the number of workers. Defaults to 0.
 
     Returns:
         CityProvision: The CityProvision object.
@@ -38,24 +70,55 @@ class CityProvision(BaseModel):
 
     services: InstanceOf[gpd.GeoDataFrame]
     demanded_buildings: InstanceOf[gpd.GeoDataFrame]
-    adjacency_matrix: InstanceOf[pd.DataFrame]
+    adjacency_matrix: Union[InstanceOf[pd.DataFrame], InstanceOf[AdjacencyMatrix]]
     threshold: int
-    calculation_type: Literal["gravity", "linear"] = "gravity"
+    calculation_type: Literal["gravity", "gravity_expected", "linear"] = "gravity"
+    round_flows: bool = False
+    links_geometry: bool = True
+    tile_size: Optional[float] = None
+    max_workers: Optional[int] = None
+    callback: Optional[Callable[[str, dict], None]] = None
+    seed: Union[int, InstanceOf[np.random.Generator]] = 0
+    inplace: bool = False
+    _distance_matrix = None
     _destination_matrix = None
+    _buildings_xy = None
+    _buildings_index = None
+
+    @model_validator(mode="before")
+    @classmethod
+    def copy_inputs(cls, data):
+        if isinstance(data, dict) and not data.get("inplace", False):
+            data = dict(data)
+            for name in ("demanded_buildings", "services"):
+                if isinstance(data.get(name), pd.DataFrame):
+                    data[name] = data[name].copy()
+        return data
+
+    @model_validator(mode="before")
+    @classmethod
+    def label_sparse_matrix(cls, data):
+        if isinstance(data, dict) and sparse.issparse(data.get("adjacency_matrix")):
+            data = dict(data)
+            data["adjacency_matrix"] = sparse_to_adjacency_matrix(
+                data["adjacency_matrix"], data["demanded_buildings"].index, data["services"].index
+            )
+        return data
 
     @field_validator("demanded_buildings")
     @classmethod
     def ensure_buildings(cls, v: gpd.GeoDataFrame) -> gpd.GeoDataFrame:
         if "demand" not in v.columns:
             raise DemandKeyError
-        v = v.copy()
-        v["demand"] = v["demand"].replace(0, np.nan)
-        rows_count = v.shape[0]
-        v = v.dropna(subset="demand")
-        dif_rows_count = rows_count - v.shape[0]
-        v["demand_left"] = v["demand"]
+        demand = v["demand"].replace(0, np.nan)
+        valid = demand.notna().to_numpy()
+        dif_rows_count = len(valid) - int(valid.sum())
+        if dif_rows_count > 0:
+            v, demand = v.take(np.flatnonzero(valid)), demand[valid]
         if v.shape[0] == 0:
             raise DemandValueError
+        v["demand"] = demand
+        v["demand_left"] = demand
         if dif_rows_count > 0:
             logger.warning(
                 "{} rows were deleted from the 'demanded_buildings' GeoDataFrame due"
@@ -69,13 +132,14 @@ class CityProvision(BaseModel):
     def ensure_services(cls, v: gpd.GeoDataFrame) -> gpd.GeoDataFrame:
         if "capacity" not in v.columns:
             raise CapacityKeyError
-        v = v.copy()
-        rows_count = v.shape[0]
-        v["capacity"] = v["capacity"].replace(0, np.nan)
-        v = v.dropna(subset="capacity")
-        dif_rows_count = rows_count - v.shape[0]
+        capacity = v["capacity"].replace(0, np.nan)
+        valid = capacity.notna().to_numpy()
+        dif_rows_count = len(valid) - int(valid.sum())
+        if dif_rows_count > 0:
+            v, capacity = v.take(np.flatnonzero(valid)), capacity[valid]
         if v.shape[0] == 0:
             raise CapacityValueError
+        v["capacity"] = capacity
         if dif_rows_count > 0:
             logger.warning(
                 "{} rows were deleted from the 'services' GeoDataFrame due to null values in the 'capacity' column",
@@ -86,11 +150,14 @@ class CityProvision(BaseModel):
 
     @model_validator(mode="after")
     def delete_useless_matrix_rows(self) -> "CityProvision":
-        self.adjacency_matrix.index = self.adjacency_matrix.index.astype(int)
-        indexes = set(self.demanded_buildings.index.astype(int).tolist())
-        rows = set(self.adjacency_matrix.index.astype(int).tolist())
-        dif = rows ^ indexes
-        self.adjacency_matrix.drop(index=(list(dif)), axis=0, inplace=True)
+        self._distance_matrix = select_adjacency_matrix(
+            self.adjacency_matrix, self.demanded_buildings.index.astype(int), self.services.index
+        )
+        if self._distance_matrix.nnz == 0:
+            logger.warning(
+                "No reachable pairs between 'demanded_buildings' and 'services' were found in the 'adjacency_matrix',"
+                " check that its labels match GeoDataFrames indexes"
+            )
         return self
 
     @model_validator(mode="after")
@@ -100,215 +167,793 @@ class CityProvision(BaseModel):
         ), f"\nThe CRS in the provided geodataframes are different.\nBuildings CRS:{self.demanded_buildings.crs}\nServices CRS:{self.services.crs} \n"
         return self
 
-    def get_provisions(self) -> Tuple[gpd.GeoDataFrame, gpd.GeoDataFrame, gpd.GeoDataFrame]:
+    @model_validator(mode="wrap")
+    @classmethod
+    def keep_buildings_index(cls, data, handler):
+        # buildings without demand are dropped, positional matrices of later deltas still follow the passed ones
+        provision = handler(data)
+        if isinstance(data, dict) and isinstance(data.get("demanded_buildings"), pd.DataFrame):
+            # the validator builds the instance, so it is the one place setting its private state
+            provision._buildings_index = data["demanded_buildings"].index  # pylint: disable=protected-access
+        return provision
+
+    # defined last, so it wraps all the validators above
+    @model_validator(mode="wrap")
+    @classmethod
+    def time_validation(cls, data, handler):
+        with StageTimer(data.get("callback") if isinstance(data, dict) else None, "validation"):
+            return handler(data)
+
+    def get_provisions(self) -> Tuple[gpd.GeoDataFrame, gpd.GeoDataFrame, Union[gpd.GeoDataFrame, pd.DataFrame]]:
         self._calculate_provisions()
-        additional_options(
-            self.demanded_buildings,
-            self.services,
-            self.adjacency_matrix,
-            self._destination_matrix,
-            self.threshold,
+        return self._provisions_output()
+
+    def add_services(
+        self,
+        services: gpd.GeoDataFrame,
+        adjacency_matrix: Union[pd.DataFrame, AdjacencyMatrix, sparse.spmatrix, sparse.sparray],
+        exact: bool = True,
+    ) -> Tuple[gpd.GeoDataFrame, gpd.GeoDataFrame, Union[gpd.GeoDataFrame, pd.DataFrame]]:
+        """Add services and re-solve only their neighbourhood, flows of other services are kept.
+
+        Args:
+            services (gpd.GeoDataFrame): new services with "capacity" column, their index must not be already used.
+            adjacency_matrix (pd.DataFrame | AdjacencyMatrix | sparse.spmatrix | sparse.sparray): distances between
+                buildings and the new services in any form accepted by the constructor, rows of a SciPy sparse
+                matrix follow the buildings passed to the constructor.
+            exact (bool): re-solve every service connected to the changed ones through reachable pairs, the result
+                is the same as of a full recomputation ("gravity" draws differ, but have the same distribution).
+                If False, only services competing for buildings within threshold are re-solved, which is faster
+                on a city where all pairs are connected, but approximate: services supplying these buildings from
+                beyond threshold keep their flows.
+
+        Returns:
+            Tuple[gpd.GeoDataFrame, gpd.GeoDataFrame, gpd.GeoDataFrame | pd.DataFrame]: updated provision buildings,
+            services and links.
+        """
+        if self._destination_matrix is None:
+            self._calculate_provisions()
+        self._detach_outputs()
+        if sparse.issparse(adjacency_matrix):
+            adjacency_matrix = sparse_to_adjacency_matrix(
+                adjacency_matrix,
+                self.demanded_buildings.index if self._buildings_index is None else self._buildings_index,
+                services.index,
+            )
+        services = self.ensure_services(services if self.inplace else services.copy())
+        if services.index.isin(self.services.index).any():
+            raise ValueError("Some of the added services are already present in 'services' GeoDataFrame")
+        new_matrix = select_adjacency_matrix(
+            adjacency_matrix, self.demanded_buildings.index.astype(int), services.index
+        )
+
+        old_matrix = self._distance_matrix
+        shape = (old_matrix.shape[0] + new_matrix.shape[0], old_matrix.shape[1])
+        indices = np.concatenate((old_matrix.indices, new_matrix.indices))
+        indptr = np.concatenate((old_matrix.indptr, old_matrix.indptr[-1] + new_matrix.indptr[1:]))
+        self._distance_matrix = sparse.csr_matrix(
+            (np.concatenate((old_matrix.data, new_matrix.data)), indices, indptr), shape=shape
         )
-        self.demanded_buildings = self.demanded_buildings.fillna(0)
-        self.services = self.services.fillna(0)
+        self._destination_matrix = sparse.csr_matrix(
+            (np.concatenate((self._destination_matrix.data, np.zeros(new_matrix.nnz))), indices, indptr), shape=shape
+        )
+        self.services = pd.concat([self.services, services])
+
+        with StageTimer(self.callback, "solve"):
+            self._resolve_services(self._neighbourhood(np.arange(old_matrix.shape[0], shape[0]), exact))
+        return self._provisions_output()
+
+    def remove_services(
+        self, index: Iterable, exact: bool = True
+    ) -> Tuple[gpd.GeoDataFrame, gpd.GeoDataFrame, Union[gpd.GeoDataFrame, pd.DataFrame]]:
+        """Remove services and re-solve only their neighbourhood, flows of other services are kept.
+
+        Args:
+            index (Iterable): index labels of the services to remove.
+            exact (bool): re-solve every affected service, see `add_services`.
+
+        Returns:
+            Tuple[gpd.GeoDataFrame, gpd.GeoDataFrame, gpd.GeoDataFrame | pd.DataFrame]: updated provision buildings,
+            services and links.
+        """
+        if self._destination_matrix is None:
+            self._calculate_provisions()
+        self._detach_outputs()
+        positions = self.services.index.get_indexer(pd.Index(index))
+        if (positions < 0).any():
+            raise KeyError("Some of the removed services are not present in 'services' GeoDataFrame")
+        keep = np.ones(len(self.services), dtype=bool)
+        keep[positions] = False
+        affected = self._neighbourhood(positions, exact)
+        affected = (np.cumsum(keep) - 1)[affected[keep[affected]]]
+
+        kept_edges = np.repeat(keep, np.diff(self._distance_matrix.indptr))
+        indptr = np.concatenate(([0], np.cumsum(np.diff(self._distance_matrix.indptr)[keep])))
+        shape = (int(keep.sum()), self._distance_matrix.shape[1])
+        indices = self._distance_matrix.indices[kept_edges]
+        self._distance_matrix = sparse.csr_matrix(
+            (self._distance_matrix.data[kept_edges], indices, indptr), shape=shape
+        )
+        self._destination_matrix = sparse.csr_matrix(
+            (self._destination_matrix.data[kept_edges], indices, indptr), shape=shape
+        )
+        self.services = self.services.take(np.flatnonzero(keep))
+
+        with StageTimer(self.callback, "solve"):
+            self._resolve_services(affected)
+        return self._provisions_output()
+
+    def set_capacity(
+        self, capacity: pd.Series, exact: bool = True
+    ) -> Tuple[gpd.GeoDataFrame, gpd.GeoDataFrame, Union[gpd.GeoDataFrame, pd.DataFrame]]:
+        """Change capacity of services and re-solve only their neighbourhood, flows of other services are kept.
+
+        Args:
+            capacity (pd.Series): new capacity values indexed by services index labels.
+            exact (bool): re-solve every affected service, see `add_services`.
+
+        Returns:
+            Tuple[gpd.GeoDataFrame, gpd.GeoDataFrame, gpd.GeoDataFrame | pd.DataFrame]: updated provision buildings,
+            services and links.
+        """
+        if self._destination_matrix is None:
+            self._calculate_provisions()
+        self._detach_outputs()
+        positions = self.services.index.get_indexer(capacity.index)
+        if (positions < 0).any():
+            raise KeyError("Some of the changed services are not present in 'services' GeoDataFrame")
+        new_capacity = self.services["capacity"].copy()
+        new_capacity.iloc[positions] = capacity.to_numpy()
+        self.services["capacity"] = new_capacity
+        with StageTimer(self.callback, "solve"):
+            self._resolve_services(self._neighbourhood(positions, exact))
+        return self._provisions_output()
+
+    def iter_provisions(
+        self, chunk_size: int = 1_000_000
+    ) -> Tuple[gpd.GeoDataFrame, gpd.GeoDataFrame, Iterator[Union[gpd.GeoDataFrame, pd.DataFrame]]]:
+        """Calculate provisions and return links lazily, in chunks derived from at most ``chunk_size`` pairs.
+
+        Only one chunk of links is held in memory at a time, pass the iterator to `write_links` to save links of
+        a whole region. Consume it before changing services of this instance.
 
+        Returns:
+            Tuple[gpd.GeoDataFrame, gpd.GeoDataFrame, Iterator[gpd.GeoDataFrame | pd.DataFrame]]: provision
+            buildings, services and an iterator over chunks of links.
+        """
+        self._calculate_provisions()
+        self._provisions_columns()
         return (
             self.demanded_buildings,
             self.services,
-            provision_matrix_transform(
+            iter_provision_links(
                 self._destination_matrix,
                 self.services,
                 self.demanded_buildings,
-                self.adjacency_matrix,
+                self._distance_matrix,
+                self.links_geometry,
+                chunk_size,
+                buildings_xy=self._buildings_centroids() if self.links_geometry else None,
             ),
         )
 
+    def _provisions_output(self) -> Tuple[gpd.GeoDataFrame, gpd.GeoDataFrame, Union[gpd.GeoDataFrame, pd.DataFrame]]:
+        self._provisions_columns()
+        with StageTimer(self.callback, "provision_matrix_transform"):
+            links = provision_matrix_transform(
+                self._destination_matrix,
+                self.services,
+                self.demanded_buildings,
+                self._distance_matrix,
+                self.links_geometry,
+                buildings_xy=self._buildings_centroids() if self.links_geometry else None,
+            )
+        return self.demanded_buildings, self.services, links
+
+    def _provisions_columns(self):
+        with StageTimer(self.callback, "additional_options"):
+            additional_options(
+                self.demanded_buildings,
+                self.services,
+                self._distance_matrix,
+                self._destination_matrix,
+                self.threshold,
+            )
+            _fill_missing(self.demanded_buildings)
+            _fill_missing(self.services)
+
     def _calculate_provisions(self):
-        self._destination_matrix = pd.DataFrame(
-            0,
-            index=self.adjacency_matrix.columns,
-            columns=self.adjacency_matrix.index,
-        )
-        self.adjacency_matrix = self.adjacency_matrix.transpose()
+        distance_matrix = self._distance_matrix
         logger.debug(
-            "Calculating provision from {} services to {} buildings with {} method, it may take a while ...",
+            "Calculating provision from {} services to {} buildings over {} reachable pairs with {} method,"
+            " it may take a while ...",
             len(self.services),
             len(self.demanded_buildings),
+            distance_matrix.nnz,
             self.calculation_type,
         )
-        if self.calculation_type == "gravity":
-            self._destination_matrix = self._provision_loop_gravity(
-                self.demanded_buildings.copy(),
-                self.services.copy(),
-                self.adjacency_matrix.copy() + 1,
-                self.threshold,
-                self._destination_matrix.copy(),
+        with StageTimer(self.callback, "solve"):
+            if self.tile_size is None:
+                flows = self._solve(
+                    self.demanded_buildings["demand"].to_numpy(float),
+                    self.services["capacity"].to_numpy(float),
+                    distance_matrix,
+                    self.threshold,
+                    self.calculation_type,
+                    self.seed,
+                    _label_keys(self.services.index),
+                    _label_keys(self.demanded_buildings.index),
+                    round_flows=self.round_flows,
+                    callback=self.callback,
+                )
+            else:
+                flows = self._solve_by_tiles()
+        self._destination_matrix = sparse.csr_matrix(
+            (flows, distance_matrix.indices, distance_matrix.indptr), shape=distance_matrix.shape
+        )
+
+    @staticmethod
+    def _solve(
+        demand: np.ndarray,
+        capacity: np.ndarray,
+        distance_matrix: sparse.csr_matrix,
+        threshold: int,
+        calculation_type: str,
+        seed: Union[int, np.random.Generator, np.random.SeedSequence] = 0,
+        services_keys: Optional[np.ndarray] = None,
+        buildings_keys: Optional[np.ndarray] = None,
+        round_flows: bool = False,
+        callback: Optional[ProvisionCallback] = None,
+    ) -> np.ndarray:
+        """Solve provision of positional arrays, see `_provision_loop_gravity`, `_provision_loop_expected`
+        and `_provision_loop_linear`.
+
+        If keys of services and buildings are given, the problem is solved with rows and columns sorted by them,
+        so random draws and ties between equal alternatives don't depend on the order rows were passed in.
+        """
+        if services_keys is not None and not (_is_sorted(services_keys) and _is_sorted(buildings_keys)):
+            sorted_matrix, services_order, buildings_order, data_order = _sort_matrix(
+                distance_matrix, services_keys, buildings_keys
             )
+            flows = np.empty(distance_matrix.nnz, dtype=float)
+            flows[data_order] = CityProvision._solve(
+                demand[buildings_order],
+                capacity[services_order],
+                sorted_matrix,
+                threshold,
+                calculation_type,
+                seed,
+                round_flows=round_flows,
+                callback=callback,
+            )
+            return flows
+        if calculation_type in ("gravity", "gravity_expected"):
+            shifted_matrix = sparse.csr_matrix(
+                (distance_matrix.data + 1, distance_matrix.indices, distance_matrix.indptr),
+                shape=distance_matrix.shape,
+            )
+            if calculation_type == "gravity_expected":
+                return CityProvision._provision_loop_expected(
+                    demand, capacity, shifted_matrix, threshold, callback, round_flows
+                )
+            return CityProvision._provision_loop_gravity(demand, capacity, shifted_matrix, threshold, callback, seed)
+        return CityProvision._provision_loop_linear(demand, capacity, distance_matrix, threshold, callback)
+
+    def _solve_by_tiles(self) -> np.ndarray:
+        """Solve provision for square tiles of buildings independently, then reconcile leftovers across tiles.
+
+        Capacity of every service is split between tiles proportionally to the demand it reaches within threshold
+        in each tile (or to all the demand it reaches, if there is none within threshold), so tiles share no state
+        and can be solved in parallel. Capacity and demand left after tiles, mostly around tile borders,
+        are distributed by one more pass over the remaining pairs only.
+
+        Solvers only hold arrays of one tile, and the bookkeeping goes over blocks of matrix rows, so the matrix
+        may be memory-mapped. Flows and the order of pairs by tiles are still built for all pairs of the city,
+        about 20 bytes per stored pair on top of the matrix itself.
+
+        Returns:
+            np.ndarray: flows aligned with ``self._distance_matrix.data``.
+        """
+        distance_matrix = self._distance_matrix
+        demand = self.demanded_buildings["demand"].to_numpy(float)
+        capacity = self.services["capacity"].to_numpy(float)
+        services_keys = _label_keys(self.services.index)
+        buildings_keys = _label_keys(self.demanded_buildings.index)
+
+        tiles = self._buildings_tiles()
+        n_tiles = int(tiles.max()) + 1
+        keys, keys_capacity = tiles_capacity(distance_matrix, demand, capacity, tiles, n_tiles, self.threshold)
+        seeds = tiles_seeds(self.seed, n_tiles)
+
+        logger.debug("Solving provision for {} tiles of {} size", n_tiles, self.tile_size)
+        flows = np.zeros(distance_matrix.nnz, dtype=float)
+        order, bounds = order_by_tiles(distance_matrix, tiles, n_tiles)
 
-        elif self.calculation_type == "linear":
-            self._destination_matrix = self._provision_loop_linear(
-                self.demanded_buildings.copy(),
-                self.services.copy(),
-                self.adjacency_matrix.copy(),
+        def _tiles():
+            for tile, (first, last) in enumerate(zip(bounds[:-1], bounds[1:])):
+                edges = order[first:last]
+                rows = np.searchsorted(distance_matrix.indptr, edges, side="right") - 1
+                services, services_pos = np.unique(rows, return_inverse=True)
+                buildings, buildings_pos = np.unique(distance_matrix.indices[edges], return_inverse=True)
+                indptr = np.concatenate(([0], np.cumsum(np.bincount(services_pos, minlength=len(services)))))
+                matrix = sparse.csr_matrix(
+                    (distance_matrix.data[edges], buildings_pos, indptr), shape=(len(services), len(buildings))
+                )
+                yield edges, (
+                    demand[buildings],
+                    keys_capacity[np.searchsorted(keys, services * n_tiles + tile)],
+                    matrix,
+                    self.threshold,
+                    self.calculation_type,
+                    seeds[tile],
+                    services_keys[services],
+                    buildings_keys[buildings],
+                    self.round_flows,
+                )
+
+        def _tile_solved(tile, edges, tile_flows):
+            flows[edges] = tile_flows
+            notify(
+                self.callback,
+                "tile",
+                {"tile": tile, "tiles": n_tiles, "pairs": len(edges), "flows_assigned": float(tile_flows.sum())},
+            )
+
+        with StageTimer(self.callback, "tiles"):
+            self._run_tiles(_tiles(), _tile_solved)
+
+        capacity_left, demand_left, edges, leftover_matrix = leftover_pairs(distance_matrix, flows, capacity, demand)
+        logger.debug("Reconciling provision between tiles over {} reachable pairs", len(edges))
+        with StageTimer(self.callback, "reconciliation"):
+            flows[edges] += self._solve(
+                demand_left,
+                capacity_left,
+                leftover_matrix,
                 self.threshold,
-                self._destination_matrix.copy(),
+                self.calculation_type,
+                seeds[-1],
+                services_keys,
+                buildings_keys,
+                round_flows=self.round_flows,
+                callback=self.callback,
             )
+        return flows
+
+    def _run_tiles(self, tiles: Iterable[Tuple[np.ndarray, tuple]], solved: Callable) -> None:
+        """Solve tiles (pairs positions and `_solve` arguments) one by one or in ``max_workers`` processes, passing
+        every tile number, its pairs positions and flows to ``solved``."""
+        if self.max_workers is None or self.max_workers <= 1:
+            for tile, (edges, args) in enumerate(tiles):
+                solved(tile, edges, self._solve(*args, callback=self.callback))
+            return
+        with ProcessPoolExecutor(max_workers=self.max_workers) as executor:
+            pending = {}
+            for tile, (edges, args) in enumerate(tiles):
+                pending[executor.submit(self._solve, *args)] = tile, edges
+                if len(pending) >= 2 * self.max_workers:
+                    done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        solved(*pending.pop(future), future.result())
+            for future in as_completed(pending):
+                solved(*pending[future], future.result())
+
+    def _buildings_tiles(self) -> np.ndarray:
+        """Tile number of every building, tiles are numbered in the order of their grid cells."""
+        cells = np.floor(self._buildings_centroids() / self.tile_size)
+        _, tiles = np.unique(cells, axis=0, return_inverse=True)
+        return tiles.reshape(-1)
+
+    def _detach_outputs(self):
+        """Copy buildings and services before a delta changes them, so results returned earlier stay intact."""
+        self.demanded_buildings = self.demanded_buildings.copy()
+        self.services = self.services.copy()
 
+    def _buildings_centroids(self) -> np.ndarray:
+        if self._buildings_xy is None:
+            self._buildings_xy = centroid_coords(self.demanded_buildings)
+        return self._buildings_xy
+
+    def _neighbourhood(self, services: np.ndarray, exact: bool = True) -> np.ndarray:
+        """Positions of the given services and of the services whose flows may change with them.
+
+        The threshold expansion eventually uses every reachable pair, so a change can move flows of any service
+        connected to the given ones through reachable pairs, and re-solving all of them gives the result of
+        a full recomputation. If not ``exact``, only services competing with the given ones for buildings within
+        threshold from them or currently supplied by them are taken.
+        """
+        if exact:
+            # csgraph takes a while to import and is only needed for deltas
+            from scipy.sparse import csgraph  # pylint: disable=import-outside-toplevel
+
+            n_services = self._distance_matrix.shape[0]
+            pairs = sparse.csr_matrix(
+                (
+                    np.ones(self._distance_matrix.nnz, dtype=np.int8),
+                    self._distance_matrix.indices,
+                    self._distance_matrix.indptr,
+                ),
+                shape=self._distance_matrix.shape,
+            )
+            _, labels = csgraph.connected_components(sparse.bmat([[None, pairs], [pairs.T, None]]), directed=False)
+            return np.flatnonzero(np.isin(labels[:n_services], labels[services]))
+        rows = np.repeat(np.arange(self._distance_matrix.shape[0]), np.diff(self._distance_matrix.indptr))
+        in_range = self._distance_matrix.data <= self.threshold
+        changed = np.isin(rows, services)
+        buildings = self._distance_matrix.indices[changed & (in_range | (self._destination_matrix.data > 0))]
+        competing = rows[in_range & np.isin(self._distance_matrix.indices, buildings)]
+        return np.union1d(services, competing)
+
+    def _resolve_services(self, services: np.ndarray):
+        """Release flows of the given services and solve them again against the demand left by other services."""
+        distance_matrix, destination_matrix = self._distance_matrix, self._destination_matrix
+        edges, sub_indptr = csr_rows_positions(distance_matrix.indptr, services)
+        destination_matrix.data[edges] = 0
+        demand_left = self.demanded_buildings["demand"].to_numpy(float) - np.bincount(
+            destination_matrix.indices, destination_matrix.data, minlength=distance_matrix.shape[1]
+        )
+        logger.debug("Re-solving provision of {} services over {} reachable pairs", len(services), len(edges))
+        destination_matrix.data[edges] = self._solve(
+            demand_left,
+            self.services["capacity"].to_numpy(float)[services],
+            sparse.csr_matrix(
+                (distance_matrix.data[edges], distance_matrix.indices[edges], sub_indptr),
+                shape=(len(services), distance_matrix.shape[1]),
+            ),
+            self.threshold,
+            self.calculation_type,
+            self.seed,
+            _label_keys(self.services.index)[services],
+            _label_keys(self.demanded_buildings.index),
+            round_flows=self.round_flows,
+            callback=self.callback,
+        )
+
+    @staticmethod
     def _provision_loop_gravity(
-        self,
-        houses_table: gpd.GeoDataFrame,
-        services_table: gpd.GeoDataFrame,
-        distance_matrix: pd.DataFrame,
+        demand: np.ndarray,
+        capacity: np.ndarray,
+        distance_matrix: sparse.csr_matrix,
         selection_range,
-        destination_matrix: pd.DataFrame,
-        temp_destination_matrix=None,
-    ):
-        def _calculate_flows_y(loc):
-            c = services_table.loc[loc.name]["capacity_left"]
-            d = houses_table.loc[loc.index]["demand_left"]
-            p = d / loc
-            p = p / p.sum()
-            if p.sum() == 0:
-                return loc
-            rng = np.random.default_rng(seed=0)
-            r = pd.Series(0, p.index)
-            choice = np.unique(rng.choice(p.index, int(c), p=p.values), return_counts=True)
-            choice = r.add(pd.Series(choice[1], choice[0]), fill_value=0)
-            return choice
-
-        def _balance_flows_to_demands(loc):
-            d = houses_table.loc[loc.name]["demand_left"]
-            loc = loc[loc > 0]
-            if loc.sum() > 0:
-                p = loc / loc.sum()
-                rng = np.random.default_rng(seed=0)
-                r = pd.Series(0, p.index)
-                choice = np.unique(rng.choice(p.index, int(d), p=p.values), return_counts=True)
-                choice = r.add(pd.Series(choice[1], choice[0]), fill_value=0)
-                choice = pd.Series(
-                    data=np.minimum(loc.sort_index().values, choice.sort_index().values),
-                    index=loc.sort_index().index,
-                )
-                return choice
-            return loc
-
-        temp_destination_matrix = distance_matrix.apply(lambda x: _calculate_flows_y(x[x <= selection_range]), axis=1)
-        temp_destination_matrix = temp_destination_matrix.fillna(0)
-        temp_destination_matrix = temp_destination_matrix.apply(lambda x: _balance_flows_to_demands(x))
-        temp_destination_matrix = temp_destination_matrix.fillna(0)
-        destination_matrix = destination_matrix.add(temp_destination_matrix, fill_value=0)
-        axis_1 = destination_matrix.sum(axis=1)
-        axis_0 = destination_matrix.sum(axis=0)
-        services_table["capacity_left"] = services_table["capacity"].subtract(axis_1, fill_value=0)
-        houses_table["demand_left"] = houses_table["demand"].subtract(axis_0, fill_value=0)
-
-        distance_matrix = distance_matrix.drop(
-            index=services_table[services_table["capacity_left"] == 0].index.values,
-            columns=houses_table[houses_table["demand_left"] == 0].index.values,
-            errors="ignore",
+        callback: Optional[ProvisionCallback] = None,
+        seed: Union[int, np.random.Generator, np.random.SeedSequence] = 0,
+    ) -> np.ndarray:
+        """Distribute services capacity over buildings demand with the gravity model.
+
+        All arrays are positional: ``distance_matrix`` has services as rows and buildings as columns and stores
+        only reachable pairs, ``capacity`` and ``demand`` are aligned with its rows and columns. Only whole units of
+        capacity and demand are distributed, so services with less than one unit of capacity left and buildings with
+        less than one unit of demand left are considered exhausted. The selection range is doubled until either side
+        is exhausted or every stored pair is in range and nothing more can be assigned. All samples are drawn
+        in batches from one generator created from ``seed``, a passed generator is used as is.
+
+        Returns:
+            np.ndarray: flows aligned with ``distance_matrix.data``.
+        """
+
+        def _calculate_flows_y(rows, cols, distance, capacity_left, demand_left):
+            p = demand_left[cols] / distance
+            p /= np.bincount(rows, p, minlength=len(capacity))[rows]
+            return _segmented_multinomial(rng, rows, np.floor(capacity_left).astype(np.int64), p)
+
+        def _balance_flows_to_demands(cols, flows, demand_left):
+            sel = flows > 0
+            p = flows[sel] / np.bincount(cols, flows, minlength=len(demand))[cols[sel]]
+            choice = _segmented_multinomial(rng, cols[sel], np.floor(demand_left).astype(np.int64), p)
+            balanced = np.zeros_like(flows)
+            balanced[sel] = np.minimum(flows[sel], choice)
+            return balanced
+
+        def _assign(rows, cols, distance, capacity_left, demand_left):
+            flows = _calculate_flows_y(rows, cols, distance, capacity_left, demand_left).astype(float)
+            return _balance_flows_to_demands(cols, flows, demand_left)
+
+        rng = np.random.default_rng(seed)
+        return _threshold_expansion_loop(
+            demand, capacity, distance_matrix, selection_range, _assign, "gravity", callback
         )
-        selection_range += selection_range
-        if len(distance_matrix.columns) > 0 and len(distance_matrix.index) > 0:
-            return self._provision_loop_gravity(
-                houses_table,
-                services_table,
-                distance_matrix,
-                selection_range,
-                destination_matrix,
-                temp_destination_matrix,
-            )
-        return destination_matrix
 
+    @staticmethod
+    def _provision_loop_expected(
+        demand: np.ndarray,
+        capacity: np.ndarray,
+        distance_matrix: sparse.csr_matrix,
+        selection_range,
+        callback: Optional[ProvisionCallback] = None,
+        round_flows: bool = False,
+    ) -> np.ndarray:
+        """Distribute services capacity over buildings demand by expected values of the gravity model.
+
+        Within every selection range capacity left of each service is split between buildings proportionally to
+        ``demand_left / distance``, flows into oversupplied buildings are scaled down to their demand left and
+        the capacity released this way is split again between buildings which still have demand left.
+        Every pass either exhausts all services or saturates at least one building, so balancing finishes
+        in a finite number of passes, and the cost does not depend on capacity values.
+
+        Returns:
+            np.ndarray: flows aligned with ``distance_matrix.data``, whole units if ``round_flows`` is set.
+        """
+        tolerance = 1e-6
+
+        def _balance_flows(rows, cols, distance, capacity_left, demand_left):
+            capacity_left, demand_left = capacity_left.copy(), demand_left.copy()
+            flows = np.zeros(len(rows))
+            active = np.ones(len(rows), dtype=bool)
+            while True:
+                active &= (capacity_left[rows] >= tolerance) & (demand_left[cols] >= tolerance)
+                if not active.any():
+                    return flows
+                active_rows, active_cols = rows[active], cols[active]
+                p = demand_left[active_cols] / distance[active]
+                y = capacity_left[active_rows] * p / np.bincount(active_rows, p, minlength=len(capacity))[active_rows]
+                supplied = np.bincount(active_cols, y, minlength=len(demand))
+                y *= np.minimum(1, demand_left / np.maximum(supplied, tolerance))[active_cols]
+                flows[active] += y
+                capacity_left -= np.bincount(active_rows, y, minlength=len(capacity))
+                demand_left -= np.bincount(active_cols, y, minlength=len(demand))
+
+        flows = _threshold_expansion_loop(
+            demand, capacity, distance_matrix, selection_range, _balance_flows, "gravity_expected", callback, tolerance
+        )
+        if round_flows:
+            rows = np.repeat(np.arange(distance_matrix.shape[0]), np.diff(distance_matrix.indptr))
+            flows = _round_flows(rows, distance_matrix.indices, flows, capacity, demand, tolerance)
+        return flows
+
+    @staticmethod
     def _provision_loop_linear(
-        self,
-        houses_table: gpd.GeoDataFrame,
-        services_table: gpd.GeoDataFrame,
-        distance_matrix: pd.DataFrame,
+        demand: np.ndarray,
+        capacity: np.ndarray,
+        distance_matrix: sparse.csr_matrix,
         selection_range,
-        destination_matrix: pd.DataFrame,
-    ):
-        def declare_variables(loc):
-            name = loc.name
-            nans = loc.isna()
-            index = nans[~nans].index
-            t = pd.Series(
-                [pulp.LpVariable(name=f"route_{name}_{I}", lowBound=0, cat="Integer") for I in index],
-                index,
-                dtype="object",
+        callback: Optional[ProvisionCallback] = None,
+    ) -> np.ndarray:
+        """Distribute services capacity over buildings demand by solving a transportation problem.
+
+        Each iteration maximizes the sum of flows weighted by ``1 / (distance + 1)`` over pairs within the selection
+        range, subject to the whole units of capacity and demand left. The constraint matrix of a transportation
+        problem is totally unimodular, so a basic optimal solution of the LP relaxation is already integral.
+        Flows assigned on previous iterations are kept, and after an optimal solve no pair in range connects
+        a service and a building that both have units left, so every next iteration only has to solve the pairs
+        that came into the doubled range.
+
+        Returns:
+            np.ndarray: flows aligned with ``distance_matrix.data``.
+        """
+
+        # scipy.optimize takes longer to import than the rest of the package, only load it when needed
+        from scipy import optimize  # pylint: disable=import-outside-toplevel
+
+        def _solve_transportation(rows, cols, distance, capacity_left, demand_left):
+            services, services_pos = np.unique(rows, return_inverse=True)
+            buildings, buildings_pos = np.unique(cols, return_inverse=True)
+            variables = np.arange(len(distance))
+            a_ub = sparse.vstack(
+                (
+                    sparse.csr_matrix((np.ones(len(distance)), (services_pos, variables))),
+                    sparse.csr_matrix((np.ones(len(distance)), (buildings_pos, variables))),
+                ),
+                format="csr",
             )
-            loc[~nans] = t
-            return loc
+            b_ub = np.concatenate((np.floor(capacity_left[services]), np.floor(demand_left[buildings])))
+            res = optimize.linprog(-1 / (distance + 1), A_ub=a_ub, b_ub=b_ub, bounds=(0, None), method="highs-ds")
+            if res.status != 0:
+                raise RuntimeError(f"Linear provision solve failed: {res.message}")
+            return np.round(res.x)
 
-        select = distance_matrix[distance_matrix.iloc[:] <= selection_range]
-        select = select.apply(lambda x: 1 / (x + 1), axis=1)
+        return _threshold_expansion_loop(
+            demand, capacity, distance_matrix, selection_range, _solve_transportation, "linear", callback
+        )
 
-        select = select.loc[:, ~select.columns.duplicated()].copy(deep=True)
-        select = select.loc[~select.index.duplicated(), :].copy(deep=True)
 
-        variables = select.apply(lambda x: declare_variables(x), axis=1)
+def _threshold_expansion_loop(
+    demand: np.ndarray,
+    capacity: np.ndarray,
+    distance_matrix: sparse.csr_matrix,
+    selection_range,
+    assign: Callable[[np.ndarray, np.ndarray, np.ndarray, np.ndarray, np.ndarray], np.ndarray],
+    engine: str,
+    callback: Optional[ProvisionCallback] = None,
+    min_units: float = 1,
+) -> np.ndarray:
+    """Assign flows over pairs within a doubling selection range until nothing more can be assigned.
 
-        prob = pulp.LpProblem("problem", pulp.LpMaximize)
-        for col in variables.columns:
-            t = variables[col].dropna().values
-            if len(t) > 0:
-                prob += (
-                    pulp.lpSum(t) <= houses_table["demand_left"][col],
-                    f"sum_of_capacities_{col}",
-                )
-            else:
-                pass
-
-        for index in variables.index:
-            t = variables.loc[index].dropna().values
-            if len(t) > 0:
-                prob += (
-                    pulp.lpSum(t) <= services_table["capacity_left"][index],
-                    f"sum_of_demands_{index}",
-                )
-            else:
-                pass
-        costs = []
-        for index in variables.index:
-            t = variables.loc[index].dropna()
-            t = t * select.loc[index].dropna()
-            costs.extend(t)
-        prob += (pulp.lpSum(costs), "Sum_of_Transporting_Costs")
-        prob.solve(pulp.PULP_CBC_CMD(msg=False))
-        to_df = {}
-        for var in prob.variables():
-            t = var.name.split("_")
-            try:
-                to_df[int(t[1])].update({int(t[2]): var.value()})
-            except ValueError:
-                print(t)
-            except:
-                to_df[int(t[1])] = {int(t[2]): var.value()}
-
-        result = pd.DataFrame(to_df).transpose()
-        result = result.join(
-            pd.DataFrame(
-                0,
-                columns=list(set(set(destination_matrix.columns) - set(result.columns))),
-                index=destination_matrix.index,
-            ),
-            how="outer",
+    Args:
+        demand (np.ndarray): demand of buildings, aligned with ``distance_matrix`` columns.
+        capacity (np.ndarray): capacity of services, aligned with ``distance_matrix`` rows.
+        distance_matrix (sparse.csr_matrix): services x buildings distances of reachable pairs.
+        selection_range: initial selection range.
+        assign (Callable): engine step, gets rows, columns and distances of in-range pairs between services and
+            buildings that both have at least ``min_units`` left, with capacity and demand left, and returns
+            their flows.
+        engine (str): engine name for instrumentation events.
+        callback (ProvisionCallback, optional): receives an "iteration" event after every iteration.
+        min_units (float): capacity or demand left under this amount is considered exhausted.
+
+    Returns:
+        np.ndarray: flows aligned with ``distance_matrix.data``.
+    """
+    destination = np.zeros(distance_matrix.nnz, dtype=float)
+    edges = np.flatnonzero(np.isfinite(distance_matrix.data))
+    rows = np.repeat(np.arange(distance_matrix.shape[0]), np.diff(distance_matrix.indptr))[edges]
+    cols = distance_matrix.indices[edges]
+    distance = distance_matrix.data[edges]
+    max_distance = distance.max() if len(distance) > 0 else 0
+    capacity_left = capacity.astype(float)
+    demand_left = demand.astype(float)
+    iteration = 0
+    while True:
+        alive = (capacity_left[rows] >= min_units) & (demand_left[cols] >= min_units)
+        edges, rows, cols, distance = edges[alive], rows[alive], cols[alive], distance[alive]
+        if len(edges) == 0:
+            break
+        sel = distance <= selection_range
+        flows = assign(rows[sel], cols[sel], distance[sel], capacity_left, demand_left) if sel.any() else np.zeros(0)
+        destination[edges[sel]] += flows
+        capacity_left -= np.bincount(rows[sel], flows, minlength=len(capacity))
+        demand_left -= np.bincount(cols[sel], flows, minlength=len(demand))
+        iteration += 1
+        notify(
+            callback,
+            "iteration",
+            {
+                "engine": engine,
+                "iteration": iteration,
+                "threshold": selection_range,
+                "services_left": int((capacity_left >= 1).sum()),
+                "buildings_left": int((demand_left >= 1).sum()),
+                "pairs": len(edges),
+                "pairs_in_range": int(sel.sum()),
+                "flows_assigned": float(flows.sum()),
+            },
         )
-        result = result.fillna(0)
-        destination_matrix = destination_matrix + result
-        axis_1 = destination_matrix.sum(axis=1)
-        axis_0 = destination_matrix.sum(axis=0)
-        services_table["capacity_left"] = services_table["capacity"].subtract(axis_1, fill_value=0)
-        houses_table["demand_left"] = houses_table["demand"].subtract(axis_0, fill_value=0)
-
-        distance_matrix = distance_matrix.drop(
-            index=services_table[services_table["capacity_left"] == 0].index.values,
-            columns=houses_table[houses_table["demand_left"] == 0].index.values,
-            errors="ignore",
+        if selection_range >= max_distance and flows.sum() < min_units:
+            break
+        selection_range = max(selection_range + selection_range, 1)
+    return destination
+
+
+def _fill_missing(frame: gpd.GeoDataFrame):
+    """Fill missing values with zeros, replacing only the columns which have them, so the data is not copied."""
+    for column in frame.columns[frame.isna().any().to_numpy()]:
+        if column != frame.geometry.name:
+            frame[column] = frame[column].fillna(0)
+
+
+def _round_flows(
+    rows: np.ndarray, cols: np.ndarray, flows: np.ndarray, capacity: np.ndarray, demand: np.ndarray, tolerance: float
+) -> np.ndarray:
+    """Round fractional flows to whole units without exceeding capacity and demand.
+
+    Flows are floored first, then units are given back one per pair in the order of descending fractional parts
+    until every row gets its total rounded to the nearest unit and no column gets more than its total rounded up.
+    Every pass accepts pairs ranked within the units left in both their row and column.
+    """
+    if len(flows) == 0:
+        return flows
+    rounded = np.floor(flows + tolerance)
+    rows_total = np.bincount(rows, flows, minlength=len(capacity))
+    cols_total = np.bincount(cols, flows, minlength=len(demand))
+    rows_left = np.minimum(np.round(rows_total), np.floor(capacity + tolerance))
+    cols_left = np.minimum(np.ceil(cols_total - tolerance), np.floor(demand + tolerance))
+    rows_left -= np.bincount(rows, rounded, minlength=len(capacity))
+    cols_left -= np.bincount(cols, rounded, minlength=len(demand))
+    remainder = flows - rounded
+    candidates = np.flatnonzero(remainder > tolerance)
+    while len(candidates) > 0:
+        candidates = candidates[(rows_left[rows[candidates]] >= 1) & (cols_left[cols[candidates]] >= 1)]
+        candidates = candidates[np.argsort(-remainder[candidates], kind="stable")]
+        accept = (_group_rank(rows[candidates]) < rows_left[rows[candidates]]) & (
+            _group_rank(cols[candidates]) < cols_left[cols[candidates]]
         )
+        rounded[candidates[accept]] += 1
+        rows_left -= np.bincount(rows[candidates[accept]], minlength=len(capacity))
+        cols_left -= np.bincount(cols[candidates[accept]], minlength=len(demand))
+        candidates = candidates[~accept]
+    return rounded
 
-        selection_range += selection_range
-        if len(distance_matrix.columns) > 0 and len(distance_matrix.index) > 0:
-            return self._provision_loop_linear(
-                houses_table, services_table, distance_matrix, selection_range, destination_matrix
-            )
-        return destination_matrix
+
+def _group_rank(groups: np.ndarray) -> np.ndarray:
+    """Rank of every element among the elements of its group, in the order they are given."""
+    order = np.argsort(groups, kind="stable")
+    sorted_groups = groups[order]
+    starts = np.flatnonzero(np.concatenate(([True], sorted_groups[1:] != sorted_groups[:-1])))
+    ranks = np.empty(len(groups), dtype=np.int64)
+    ranks[order] = np.arange(len(groups)) - np.repeat(starts, np.diff(np.append(starts, len(groups))))
+    return ranks
+
+
+def _label_keys(index: pd.Index) -> np.ndarray:
+    """Sortable keys of index labels, the labels themselves if numeric or their hashes otherwise."""
+    if pd.api.types.is_numeric_dtype(index.dtype):
+        return index.to_numpy()
+    return pd.util.hash_pandas_object(index, index=False).to_numpy()
+
+
+def _is_sorted(keys: np.ndarray) -> bool:
+    return bool(np.all(keys[:-1] <= keys[1:]))
+
+
+def _sort_matrix(
+    matrix: sparse.csr_matrix, rows_keys: np.ndarray, cols_keys: np.ndarray
+) -> Tuple[sparse.csr_matrix, np.ndarray, np.ndarray, np.ndarray]:
+    """Reorder rows and columns of a CSR matrix by keys.
+
+    Returns:
+        Tuple[sparse.csr_matrix, np.ndarray, np.ndarray, np.ndarray]: reordered matrix, order of rows, order of
+        columns and order of stored entries, e.g. ``matrix.data[data_order]`` is aligned with the reordered matrix.
+    """
+    rows_order = np.argsort(rows_keys, kind="stable")
+    cols_order = np.argsort(cols_keys, kind="stable")
+    rows_rank = np.empty(len(rows_order), dtype=np.int64)
+    rows_rank[rows_order] = np.arange(len(rows_order))
+    cols_rank = np.empty(len(cols_order), dtype=np.int64)
+    cols_rank[cols_order] = np.arange(len(cols_order))
+    row = rows_rank[np.repeat(np.arange(matrix.shape[0]), np.diff(matrix.indptr))]
+    col = cols_rank[matrix.indices]
+    data_order = np.lexsort((col, row))
+    indptr = np.concatenate(([0], np.cumsum(np.bincount(row, minlength=matrix.shape[0]))))
+    sorted_matrix = sparse.csr_matrix((matrix.data[data_order], col[data_order], indptr), shape=matrix.shape)
+    return sorted_matrix, rows_order, cols_order, data_order
+
+
+def _segmented_multinomial(
+    rng: np.random.Generator, segments: np.ndarray, n: np.ndarray, p: np.ndarray, chunk_size: int = 2**22
+) -> np.ndarray:
+    """Draw one multinomial sample per segment of a flat array of probabilities.
+
+    Args:
+        rng (np.random.Generator): random generator to draw from.
+        segments (np.ndarray): segment id of every element of ``p``.
+        n (np.ndarray): number of trials for every segment id.
+        p (np.ndarray): probabilities, summing up to one within every segment.
+        chunk_size (int): maximum number of cells in a padded block passed to ``rng.multinomial``.
+
+    Returns:
+        np.ndarray: drawn counts aligned with ``p``.
+    """
+    counts = np.zeros(len(p), dtype=np.int64)
+    if len(p) == 0:
+        return counts
+    ids, lengths, starts, elements, bounds = _segments_by_length(segments)
+    for first, last in zip(bounds[:-1], bounds[1:]):
+        width = lengths[first:last].max()
+        step = max(1, chunk_size // width)
+        for lo in range(first, last, step):
+            hi = min(lo + step, last)
+            chunk = elements[starts[lo] : starts[hi - 1] + lengths[hi - 1]]
+            counts[chunk] = _padded_multinomial(rng, n[ids[lo:hi]], p[chunk], lengths[lo:hi], width)
+    return counts
+
+
+def _segments_by_length(segments: np.ndarray) -> Tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray, np.ndarray]:
+    """Group elements by segment, with segments of similar length next to each other.
+
+    Returns:
+        Tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray, np.ndarray]: ids, lengths and starts of segments,
+        positions of elements in segments order and bounds of groups of segments with lengths within a power of two.
+    """
+    order = np.argsort(segments, kind="stable")
+    ids, lengths = np.unique(segments[order], return_counts=True)
+    starts = np.cumsum(lengths) - lengths
+
+    # segments of similar length are grouped together, so padding them into one block stays cheap
+    by_length = np.argsort(np.ceil(np.log2(lengths)), kind="stable")
+    ids, lengths, starts = ids[by_length], lengths[by_length], starts[by_length]
+    new_starts = np.cumsum(lengths) - lengths
+    elements = order[np.arange(len(order)) + np.repeat(starts - new_starts, lengths)]
+    classes = np.ceil(np.log2(lengths))
+    bounds = np.concatenate(([0], np.flatnonzero(np.diff(classes)) + 1, [len(ids)]))
+    return ids, lengths, new_starts, elements, bounds
+
+
+def _padded_multinomial(
+    rng: np.random.Generator, n: np.ndarray, p: np.ndarray, lengths: np.ndarray, width: int
+) -> np.ndarray:
+    """Draw one multinomial sample per consecutive segment of ``p``, padded into one block of ``width`` columns."""
+    row = np.repeat(np.arange(len(lengths)), lengths)
+    starts = np.cumsum(lengths) - lengths
+    # segments are right-aligned, numpy assigns the remaining probability mass to the last category
+    col = width - lengths[row] + np.arange(len(p)) - starts[row]
+    pvals = np.zeros((len(lengths), width))
+    pvals[row, col] = p
+    return rng.multinomial(n, pvals)[row, col]
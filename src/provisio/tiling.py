@@ -0,0 +1,124 @@
+from typing import List, Tuple, Union
+
+import numpy as np
+from scipy import sparse
+
+from .utils import csr_row_blocks
+
+# stored pairs per block of matrix rows the tiled solve bookkeeping goes over at once
+BLOCK_SIZE = 2**22
+
+
+def tiles_seeds(seed: Union[int, np.random.Generator], n_tiles: int) -> List[np.random.SeedSequence]:
+    """Seed sequences of every tile and of the reconciliation pass, spawned from ``seed``."""
+    # tiles are numbered by their grid cells, so every tile gets the same random stream however it is solved
+    if isinstance(seed, np.random.Generator):
+        seed = int(seed.integers(2**63))
+    return np.random.SeedSequence(seed).spawn(n_tiles + 1)
+
+
+def tiles_capacity(
+    distance_matrix: sparse.csr_matrix,
+    demand: np.ndarray,
+    capacity: np.ndarray,
+    tiles: np.ndarray,
+    n_tiles: int,
+    threshold: float,
+) -> Tuple[np.ndarray, np.ndarray]:
+    """Sorted keys ``service * n_tiles + tile`` of tiles reached by every service and whole units of service capacity
+    split between them.
+
+    Capacity is split proportionally to the demand of the tile reached within threshold, or to all the demand of the
+    tile reached by the service if it reaches none within threshold at all.
+    """
+    indptr = distance_matrix.indptr
+    keys, weights = [], []
+    for first, last in csr_row_blocks(indptr, BLOCK_SIZE):
+        cols = distance_matrix.indices[indptr[first] : indptr[last]]
+        rows = np.repeat(np.arange(last - first), np.diff(indptr[first : last + 1]))
+        block_weights = np.where(distance_matrix.data[indptr[first] : indptr[last]] <= threshold, demand[cols], 0)
+        out_of_range = np.bincount(rows, block_weights, minlength=last - first) == 0
+        block_weights = np.where(out_of_range[rows], demand[cols], block_weights)
+        block_keys, key_index = np.unique((rows + first) * n_tiles + tiles[cols], return_inverse=True)
+        keys.append(block_keys)
+        weights.append(np.bincount(key_index.reshape(-1), block_weights))
+    keys = np.concatenate(keys)
+    return keys, split_capacity(np.floor(capacity), keys // n_tiles, np.concatenate(weights))
+
+
+def order_by_tiles(
+    distance_matrix: sparse.csr_matrix, tiles: np.ndarray, n_tiles: int
+) -> Tuple[np.ndarray, np.ndarray]:
+    """Positions of stored pairs stably sorted by the tile of their building and bounds of every tile among them.
+
+    Pairs are counting sorted block by block of matrix rows, the order itself is the only array of all pairs.
+    """
+    indptr, indices = distance_matrix.indptr, distance_matrix.indices
+    blocks = list(csr_row_blocks(indptr, BLOCK_SIZE))
+    counts = np.zeros(n_tiles, dtype=np.int64)
+    for first, last in blocks:
+        counts += np.bincount(tiles[indices[indptr[first] : indptr[last]]], minlength=n_tiles)
+    bounds = np.concatenate(([0], np.cumsum(counts)))
+    filled = bounds[:-1].copy()
+    order = np.empty(bounds[-1], dtype=np.int32 if bounds[-1] < 2**31 else np.int64)
+    for first, last in blocks:
+        edge_tiles = tiles[indices[indptr[first] : indptr[last]]]
+        block_order = np.argsort(edge_tiles, kind="stable")
+        sorted_tiles = edge_tiles[block_order]
+        rank = np.arange(len(sorted_tiles)) - np.searchsorted(sorted_tiles, sorted_tiles)
+        order[filled[sorted_tiles] + rank] = indptr[first] + block_order
+        filled += np.bincount(edge_tiles, minlength=n_tiles)
+    return order, bounds
+
+
+def leftover_pairs(
+    distance_matrix: sparse.csr_matrix, flows: np.ndarray, capacity: np.ndarray, demand: np.ndarray
+) -> Tuple[np.ndarray, np.ndarray, np.ndarray, sparse.csr_matrix]:
+    """Capacity and demand left after flows, positions of pairs which can still get flows and the matrix of them."""
+    indptr, indices = distance_matrix.indptr, distance_matrix.indices
+    blocks = list(csr_row_blocks(indptr, BLOCK_SIZE))
+    capacity_left = capacity.copy()
+    provided = np.zeros(len(demand))
+    for first, last in blocks:
+        block_flows = flows[indptr[first] : indptr[last]]
+        rows = np.repeat(np.arange(last - first), np.diff(indptr[first : last + 1]))
+        capacity_left[first:last] -= np.bincount(rows, block_flows, minlength=last - first)
+        np.add.at(provided, indices[indptr[first] : indptr[last]], block_flows)
+    demand_left = demand - provided
+
+    edges, counts = [], []
+    for first, last in blocks:
+        rows = np.repeat(np.arange(last - first), np.diff(indptr[first : last + 1]))
+        alive = (capacity_left[first:last][rows] >= 1) & (demand_left[indices[indptr[first] : indptr[last]]] >= 1)
+        edges.append(indptr[first] + np.flatnonzero(alive))
+        counts.append(np.bincount(rows[alive], minlength=last - first))
+    edges = np.concatenate(edges)
+    leftover_matrix = sparse.csr_matrix(
+        (distance_matrix.data[edges], indices[edges], np.concatenate(([0], np.cumsum(np.concatenate(counts))))),
+        shape=distance_matrix.shape,
+    )
+    return capacity_left, demand_left, edges, leftover_matrix
+
+
+def split_capacity(capacity: np.ndarray, key_rows: np.ndarray, weights: np.ndarray) -> np.ndarray:
+    """Split whole units of services capacity between keys proportionally to weights.
+
+    Args:
+        capacity (np.ndarray): whole units of capacity of every service.
+        key_rows (np.ndarray): service position of every key, sorted.
+        weights (np.ndarray): non-negative weight of every key.
+
+    Returns:
+        np.ndarray: integer capacity of every key, summing up to service capacity for services with positive weights.
+    """
+    total = np.bincount(key_rows, weights, minlength=len(capacity))[key_rows]
+    share = capacity[key_rows] * np.divide(weights, total, out=np.zeros_like(weights), where=total > 0)
+    split = np.floor(share)
+    remainder = share - split
+    # largest remainder method: units lost by flooring go to the keys with the biggest fractional parts
+    deficit = np.round(np.bincount(key_rows, remainder, minlength=len(capacity)))
+    order = np.lexsort((-remainder, key_rows))
+    starts = np.searchsorted(key_rows[order], key_rows[order])
+    rank = np.arange(len(order)) - starts
+    split[order[rank < deficit[key_rows[order]]]] += 1
+    return split
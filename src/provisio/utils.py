@@ -1,60 +1,265 @@
-from typing import Tuple
+import json
+import os
+from typing import Callable, Iterable, Iterator, Optional, Tuple, Union
 
 import geopandas as gpd
 import numpy as np
 import pandas as pd
 import shapely
+from scipy import sparse
+
+from .provisio_exceptions import AdjacencyMatrixValueError
+
+EDGE_TABLE_COLUMNS = ("building_index", "service_index", "distance")
+
+
+def sparse_to_edge_table(
+    matrix: Union[sparse.spmatrix, sparse.sparray], buildings_index: pd.Index, services_index: pd.Index
+) -> pd.DataFrame:
+    """Convert a sparse buildings x services distance matrix into a long-format edge table.
+
+    Args:
+        matrix (sparse.spmatrix | sparse.sparray): matrix with rows positionally matching ``buildings_index`` and
+            columns positionally matching ``services_index``. Only stored entries (explicit zeros included)
+            are treated as reachable pairs.
+        buildings_index (pd.Index): index of buildings GeoDataFrame.
+        services_index (pd.Index): index of services GeoDataFrame.
+
+    Returns:
+        pd.DataFrame: edge table with "building_index", "service_index" and "distance" columns.
+    """
+    if matrix.shape != (len(buildings_index), len(services_index)):
+        raise AdjacencyMatrixValueError
+    matrix = sparse.coo_matrix(matrix)
+    return pd.DataFrame(
+        {
+            "building_index": buildings_index.to_numpy()[matrix.row],
+            "service_index": services_index.to_numpy()[matrix.col],
+            "distance": matrix.data,
+        }
+    )
+
+
+def adjacency_to_csr(matrix: pd.DataFrame, buildings_index: pd.Index, services_index: pd.Index) -> sparse.csr_matrix:
+    """Build a services x buildings sparse distance matrix aligned with the given indexes.
+
+    Args:
+        matrix (pd.DataFrame): either a dense matrix with buildings as index and services as columns,
+            or an edge table with "building_index", "service_index" and "distance" columns.
+        buildings_index (pd.Index): index of buildings, defines the order of matrix columns.
+        services_index (pd.Index): index of services, defines the order of matrix rows.
+
+    Returns:
+        sparse.csr_matrix: matrix storing only finite distances between known buildings and services. Zero distances
+        are kept as explicit entries, duplicated pairs keep the shortest distance.
+    """
+    if set(EDGE_TABLE_COLUMNS).issubset(matrix.columns):
+        buildings_pos = buildings_index.get_indexer(matrix["building_index"])
+        services_pos = services_index.get_indexer(matrix["service_index"])
+        distance = matrix["distance"].to_numpy(float)
+    else:
+        rows = buildings_index.get_indexer(matrix.index.astype(int))
+        cols = services_index.get_indexer(matrix.columns)
+        values = matrix.to_numpy(float)[np.ix_(rows >= 0, cols >= 0)]
+        rows, cols = rows[rows >= 0], cols[cols >= 0]
+        row, col = np.nonzero(np.isfinite(values))
+        buildings_pos, services_pos, distance = rows[row], cols[col], values[row, col]
+
+    keep = (buildings_pos >= 0) & (services_pos >= 0) & np.isfinite(distance)
+    return positions_to_csr(
+        services_pos[keep], buildings_pos[keep], distance[keep], (len(services_index), len(buildings_index))
+    )
+
+
+def positions_to_csr(rows: np.ndarray, cols: np.ndarray, data: np.ndarray, shape: Tuple[int, int]) -> sparse.csr_matrix:
+    """Build a CSR matrix with sorted indices from positional entries, duplicated entries keep the minimal value."""
+    order = np.argsort(rows, kind="stable")
+    indptr = np.concatenate(([0], np.cumsum(np.bincount(rows, minlength=shape[0]))))
+    matrix = sparse.csr_matrix((data[order], cols[order], indptr), shape=shape)
+    matrix.has_canonical_format = False
+    matrix.sort_indices()
+
+    row = np.repeat(np.arange(shape[0]), np.diff(matrix.indptr))
+    first = np.ones(matrix.nnz, dtype=bool)
+    first[1:] = (np.diff(matrix.indices) != 0) | (np.diff(row) != 0)
+    if first.all():
+        return matrix
+    starts = np.flatnonzero(first)
+    indptr = np.concatenate(([0], np.cumsum(np.bincount(row[starts], minlength=shape[0]))))
+    return sparse.csr_matrix((np.minimum.reduceat(matrix.data, starts), matrix.indices[starts], indptr), shape=shape)
+
+
+def csr_rows_positions(indptr: np.ndarray, rows: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    """Positions of the stored entries of the given CSR rows and the indptr of a matrix made of these rows.
+
+    Rows equal to -1 are treated as empty.
+    """
+    lengths = np.where(rows >= 0, np.diff(indptr)[rows], 0)
+    sub_indptr = np.concatenate(([0], np.cumsum(lengths)))
+    positions = np.arange(sub_indptr[-1]) + np.repeat(indptr[rows] - sub_indptr[:-1], lengths)
+    return positions, sub_indptr
+
+
+def csr_row_blocks(indptr: np.ndarray, chunk_size: int) -> Iterator[Tuple[int, int]]:
+    """Ranges ``[first, last)`` of consecutive CSR rows holding at most ``chunk_size`` stored entries each,
+    a longer row makes a block by itself."""
+    n_rows = len(indptr) - 1
+    first = 0
+    while first < n_rows:
+        last = max(int(np.searchsorted(indptr, indptr[first] + chunk_size, side="right")) - 1, first + 1)
+        yield first, last
+        first = last
+
+
+def centroid_coords(gdf: gpd.GeoDataFrame) -> np.ndarray:
+    """Centroid coordinates of geometries as an (n, 2) array, computed without building a GeoSeries."""
+    centroids = shapely.centroid(np.asarray(gdf.geometry.values))
+    return np.column_stack((shapely.get_x(centroids), shapely.get_y(centroids)))
 
 
 def provision_matrix_transform(
-    destination_matrix: pd.DataFrame,
+    destination_matrix: sparse.csr_matrix,
     services: gpd.GeoDataFrame,
     buildings: gpd.GeoDataFrame,
-    distance_matrix: pd.DataFrame,
-):
-    def subfunc(loc):
-        try:
-            return [
-                {
-                    "building_index": int(k),
-                    "demand": int(v),
-                    "service_index": int(loc.name),
-                }
-                for k, v in loc.to_dict().items()
-            ]
-        except:
-            return np.NaN
-
-    def subfunc_geom(loc):
-        return shapely.geometry.LineString(
-            (
-                buildings_["geometry"][loc["building_index"]],
-                services_["geometry"][loc["service_index"]],
-            )
+    distance_matrix: sparse.csr_matrix,
+    geometry: bool = True,
+    buildings_xy: Optional[np.ndarray] = None,
+    services_xy: Optional[np.ndarray] = None,
+) -> Union[gpd.GeoDataFrame, pd.DataFrame]:
+    """Build provision links from the services x buildings flows.
+
+    ``destination_matrix`` and ``distance_matrix`` must share the same sparsity structure, rows and columns
+    positionally match ``services`` and ``buildings``. If ``geometry`` is False, a plain DataFrame without
+    link lines is returned. Already computed centroid coordinates can be passed as ``buildings_xy`` and
+    ``services_xy``.
+    """
+    return next(
+        iter_provision_links(
+            destination_matrix,
+            services,
+            buildings,
+            distance_matrix,
+            geometry,
+            max(destination_matrix.nnz, 1),
+            buildings_xy,
+            services_xy,
         )
+    )
 
-    buildings_ = buildings.copy()
-    services_ = services.copy()
-    buildings_.geometry = buildings_.centroid
-    services_.geometry = services_.centroid
-    flat_matrix = destination_matrix.transpose().apply(lambda x: subfunc(x[x > 0]), result_type="reduce")
 
-    distribution_links = gpd.GeoDataFrame(data=[item for sublist in list(flat_matrix) for item in sublist])
+def iter_provision_links(
+    destination_matrix: sparse.csr_matrix,
+    services: gpd.GeoDataFrame,
+    buildings: gpd.GeoDataFrame,
+    distance_matrix: sparse.csr_matrix,
+    geometry: bool = True,
+    chunk_size: int = 1_000_000,
+    buildings_xy: Optional[np.ndarray] = None,
+    services_xy: Optional[np.ndarray] = None,
+) -> Iterator[Union[gpd.GeoDataFrame, pd.DataFrame]]:
+    """Build provision links from the services x buildings flows in chunks, see `provision_matrix_transform`.
 
-    distribution_links["distance"] = distribution_links.apply(
-        lambda x: distance_matrix.loc[x["service_index"]][x["building_index"]],
-        axis=1,
-        result_type="reduce",
-    )
+    Every chunk is derived from at most ``chunk_size`` consecutive stored pairs of ``destination_matrix``,
+    so only one chunk of links is held in memory at a time. Concatenated chunks are equal to the result of
+    `provision_matrix_transform`, at least one (maybe empty) chunk is yielded.
+    """
+    flows = destination_matrix.data
+    integral = np.array_equal(flows, np.round(flows))
+    if geometry and buildings_xy is None:
+        buildings_xy = centroid_coords(buildings)
+    if geometry and services_xy is None:
+        services_xy = centroid_coords(services)
 
-    sel = distribution_links["building_index"].isin(buildings_.index.values) & distribution_links["service_index"].isin(
-        services_.index.values
-    )
-    sel = distribution_links.loc[sel[sel].index.values]
-    distribution_links = distribution_links.set_geometry(sel.apply(lambda x: subfunc_geom(x), axis=1)).set_crs(
-        buildings_.crs
-    )
-    return distribution_links
+    for first in range(0, max(destination_matrix.nnz, 1), chunk_size):
+        positions = first + np.flatnonzero(flows[first : first + chunk_size] > 0)
+        services_pos = np.searchsorted(destination_matrix.indptr, positions, side="right") - 1
+        buildings_pos = destination_matrix.indices[positions]
+        distribution_links = pd.DataFrame(
+            data={
+                "building_index": buildings.index.to_numpy()[buildings_pos],
+                "demand": flows[positions].astype(int) if integral else flows[positions],
+                "service_index": services.index.to_numpy()[services_pos],
+                "distance": distance_matrix.data[positions],
+            }
+        )
+        if not geometry:
+            yield distribution_links
+            continue
+        coords = np.stack((buildings_xy[buildings_pos], services_xy[services_pos]), axis=1)
+        yield gpd.GeoDataFrame(distribution_links, geometry=shapely.linestrings(coords), crs=buildings.crs)
+
+
+def write_links(links: Iterable[Union[gpd.GeoDataFrame, pd.DataFrame]], path: str, driver: Optional[str] = None) -> int:
+    """Write provision links chunk by chunk, so only one chunk is held in memory at a time.
+
+    Args:
+        links (Iterable[gpd.GeoDataFrame | pd.DataFrame]): chunks of links, e.g. returned by `get_service_provision`
+            with ``links_chunk_size``.
+        path (str): file to write to, overwritten if exists.
+        driver (str, optional): "Parquet" to write GeoParquet (plain Parquet for links without geometry), requires
+            pyarrow. Any other value is passed to `GeoDataFrame.to_file` and must name a driver which supports
+            appending, e.g. "FlatGeobuf" or "GPKG". Defaults to "Parquet" for ".parquet" files and to the driver
+            inferred from the file extension otherwise.
+
+    Returns:
+        int: number of written links.
+
+    Raises:
+        ValueError: If links without geometry are written with a driver other than "Parquet".
+    """
+    if driver is None and os.path.splitext(path)[1].lower() in (".parquet", ".geoparquet"):
+        driver = "Parquet"
+    count, empty, writer = 0, None, None
+    try:
+        for chunk in links:
+            if driver != "Parquet" and not isinstance(chunk, gpd.GeoDataFrame):
+                raise ValueError(
+                    f"Links without geometry (links_geometry=False) can only be written to Parquet, not to '{path}'"
+                )
+            if len(chunk) == 0:
+                empty = chunk
+                continue
+            if driver == "Parquet":
+                table = _links_to_arrow(chunk)
+                if writer is None:
+                    import pyarrow.parquet as pq  # pylint: disable=import-outside-toplevel
+
+                    writer = pq.ParquetWriter(path, table.schema)
+                writer.write_table(table)
+            else:
+                chunk.to_file(path, driver=driver, mode="a" if count > 0 else "w")
+            count += len(chunk)
+    finally:
+        if writer is not None:
+            writer.close()
+    if count == 0 and empty is not None:
+        if driver == "Parquet":
+            empty.to_parquet(path)
+        else:
+            empty.to_file(path, driver=driver)
+    return count
+
+
+def _links_to_arrow(links: Union[gpd.GeoDataFrame, pd.DataFrame]):
+    import pyarrow as pa  # pylint: disable=import-outside-toplevel
+
+    if not isinstance(links, gpd.GeoDataFrame):
+        return pa.Table.from_pandas(links, preserve_index=False)
+    name = links.geometry.name
+    table = pa.Table.from_pandas(pd.DataFrame(links.drop(columns=name)), preserve_index=False)
+    table = table.append_column(name, pa.array(shapely.to_wkb(np.asarray(links.geometry.values)), type=pa.binary()))
+    geo = {
+        "version": "1.0.0",
+        "primary_column": name,
+        "columns": {
+            name: {
+                "encoding": "WKB",
+                "geometry_types": ["LineString"],
+                "crs": links.crs.to_json_dict() if links.crs is not None else None,
+            }
+        },
+    }
+    return table.replace_schema_metadata({**(table.schema.metadata or {}), b"geo": json.dumps(geo).encode()})
 
 
 def additional_options(
@@ -64,43 +269,108 @@ def additional_options(
     destination_matrix,
     normative_distance,
 ):
-    # bad performance
-    # bad code
-    # rewrite to vector operations [for col in ****]
-    buildings["supplyed_demands_within"] = 0
-    buildings["supplyed_demands_without"] = 0
-    services["carried_capacity_within"] = 0
-    services["carried_capacity_without"] = 0
-    for i in range(len(destination_matrix)):
-        loc = destination_matrix.iloc[i]
-        s = matrix.loc[loc.name] <= normative_distance
-        within = loc[s]
-        without = loc[~s]
-        within = within[within > 0]
-        without = without[without > 0]
-        buildings["demand_left"] = buildings["demand_left"].sub(within.add(without, fill_value=0), fill_value=0)
-        buildings["supplyed_demands_within"] = buildings["supplyed_demands_within"].add(within, fill_value=0)
-        buildings["supplyed_demands_without"] = buildings["supplyed_demands_without"].add(without, fill_value=0)
-        services.at[loc.name, "capacity_left"] = (
-            services.at[loc.name, "capacity_left"] - within.add(without, fill_value=0).sum()
-        )
-        services.at[loc.name, "carried_capacity_within"] = (
-            services.at[loc.name, "carried_capacity_within"] + within.sum()
-        )
-        services.at[loc.name, "carried_capacity_without"] = (
-            services.at[loc.name, "carried_capacity_without"] + without.sum()
-        )
+    within = sparse.csr_matrix(
+        (
+            np.where(matrix.data <= normative_distance, destination_matrix.data, 0),
+            destination_matrix.indices,
+            destination_matrix.indptr,
+        ),
+        shape=destination_matrix.shape,
+    )
+    without = destination_matrix - within
+
+    buildings["supplyed_demands_within"] = np.asarray(within.sum(axis=0)).ravel()
+    buildings["supplyed_demands_without"] = np.asarray(without.sum(axis=0)).ravel()
+    buildings["demand_left"] = (
+        buildings["demand"] - buildings["supplyed_demands_within"] - buildings["supplyed_demands_without"]
+    )
+    services["carried_capacity_within"] = np.asarray(within.sum(axis=1)).ravel()
+    services["carried_capacity_without"] = np.asarray(without.sum(axis=1)).ravel()
+    services["capacity_left"] = (
+        services["capacity"] - services["carried_capacity_within"] - services["carried_capacity_without"]
+    )
     buildings["provison_value"] = buildings["supplyed_demands_within"] / buildings["demand"]
     services["service_load"] = services["capacity"] - services["capacity_left"]
 
 
+def catchment_aggregates(
+    matrix: sparse.csr_matrix,
+    demand: np.ndarray,
+    capacity: np.ndarray,
+    threshold: float,
+    decay: Optional[Callable[[np.ndarray], np.ndarray]] = None,
+    chunk_size: int = 2**24,
+) -> Tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray]:
+    """Two-step floating catchment area aggregates over a services x buildings distance matrix.
+
+    Rows are processed in blocks of at most ``chunk_size`` stored pairs (a block holds at least one row), so memory
+    does not grow with the matrix, which may be memory-mapped.
+
+    Args:
+        matrix (sparse.csr_matrix): services x buildings distances of reachable pairs.
+        demand (np.ndarray): demand of buildings, aligned with matrix columns.
+        capacity (np.ndarray): capacity of services, aligned with matrix rows.
+        threshold (float): pairs farther than this are out of catchment.
+        decay (Callable[[np.ndarray], np.ndarray], optional): weights of distances within threshold,
+            pairs are weighted equally if None.
+        chunk_size (int): maximum number of stored pairs processed at once.
+
+    Returns:
+        Tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray]: weighted demand within catchment and capacity to
+        demand ratio of every service, weighted capacity within threshold and accessibility (sum of ratios of
+        reachable services) of every building.
+    """
+    n_services, n_buildings = matrix.shape
+    demand_within = np.zeros(n_services)
+    supply_ratio = np.zeros(n_services)
+    capacity_within = np.zeros(n_buildings)
+    accessibility = np.zeros(n_buildings)
+    for first, last in csr_row_blocks(np.asarray(matrix.indptr), chunk_size):
+        rows, cols, weights = _catchment_pairs(matrix, first, last, threshold, decay)
+        block_demand = np.bincount(rows, weights * demand[cols], minlength=last - first)
+        block_capacity = capacity[first:last]
+        block_ratio = np.divide(block_capacity, block_demand, out=np.zeros(last - first), where=block_demand > 0)
+        demand_within[first:last] = block_demand
+        supply_ratio[first:last] = block_ratio
+        capacity_within += np.bincount(cols, weights * block_capacity[rows], minlength=n_buildings)
+        accessibility += np.bincount(cols, weights * block_ratio[rows], minlength=n_buildings)
+    return demand_within, supply_ratio, capacity_within, accessibility
+
+
+def _catchment_pairs(
+    matrix: sparse.csr_matrix,
+    first: int,
+    last: int,
+    threshold: float,
+    decay: Optional[Callable[[np.ndarray], np.ndarray]],
+) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """Rows (counted from ``first``), columns and weights of the pairs of rows ``[first, last)`` within threshold."""
+    indptr = np.asarray(matrix.indptr)
+    distance = np.asarray(matrix.data[indptr[first] : indptr[last]], dtype=float)
+    cols = np.asarray(matrix.indices[indptr[first] : indptr[last]])
+    rows = np.repeat(np.arange(last - first), np.diff(indptr[first : last + 1]))
+    within = distance <= threshold
+    rows, cols, distance = rows[within], cols[within], distance[within]
+    weights = np.ones(len(distance)) if decay is None else np.asarray(decay(distance), dtype=float)
+    return rows, cols, weights
+
+
 def is_shown(
     buildings: gpd.GeoDataFrame, services: gpd.GeoDataFrame, links: gpd.GeoDataFrame, selection_zone: gpd.GeoDataFrame
 ) -> Tuple[gpd.GeoDataFrame, gpd.GeoDataFrame, gpd.GeoDataFrame]:
-    buildings.reset_index(inplace=True)
-    buildings = gpd.overlay(buildings, selection_zone, how="intersection")
-    buildings.set_index("index", inplace=True)
-    links = links[links["building_index"].isin(buildings.index.tolist())]
-    services_to_keep = set(links["service_index"].tolist())
-    services.drop(list(set(services.index.tolist()) - services_to_keep), inplace=True)
+    """Select buildings intersecting the selection zone, their links and the services they are linked to.
+
+    Buildings are queried through their spatial index, which geopandas builds once and keeps with the
+    GeoDataFrame, so repeated queries on the same result (e.g. on every map pan) only pay for the query.
+    Inputs are not modified.
+
+    Returns:
+        Tuple[gpd.GeoDataFrame, gpd.GeoDataFrame, gpd.GeoDataFrame]: selected buildings, services and links.
+    """
+    if selection_zone.crs is not None and buildings.crs is not None and selection_zone.crs != buildings.crs:
+        selection_zone = selection_zone.to_crs(buildings.crs)
+    _, positions = buildings.sindex.query(np.asarray(selection_zone.geometry.values), predicate="intersects")
+    buildings = buildings.take(np.unique(positions))
+    links = links.take(np.flatnonzero(links["building_index"].isin(buildings.index)))
+    services = services.take(np.flatnonzero(services.index.isin(links["service_index"].unique())))
     return buildings, services, links
@@ -0,0 +1,32 @@
+from typing import Tuple
+
+import geopandas as gpd
+import numpy as np
+import pandas as pd
+import pytest
+import shapely
+
+
+def make_city(
+    n_buildings: int = 300, n_services: int = 20, size: float = 1_000, max_distance: float = 30, seed: int = 0
+) -> Tuple[gpd.GeoDataFrame, gpd.GeoDataFrame, pd.DataFrame]:
+    """Random buildings and services with a dense buildings x services matrix of travel times, NaN past
+    ``max_distance``."""
+    rng = np.random.default_rng(seed)
+    buildings_xy = rng.uniform(0, size, (n_buildings, 2))
+    services_xy = rng.uniform(0, size, (n_services, 2))
+    buildings = gpd.GeoDataFrame(
+        {"demand": rng.integers(1, 15, n_buildings)}, geometry=shapely.points(buildings_xy), crs=32636
+    )
+    services = gpd.GeoDataFrame(
+        {"capacity": rng.integers(10, 60, n_services)}, geometry=shapely.points(services_xy), crs=32636
+    )
+    distance = np.linalg.norm(buildings_xy[:, None] - services_xy[None], axis=2) / 20
+    distance = np.round(distance * rng.uniform(1.1, 1.5, distance.shape), 1)
+    matrix = pd.DataFrame(np.where(distance <= max_distance, distance, np.nan), buildings.index, services.index)
+    return buildings, services, matrix
+
+
+@pytest.fixture
+def city() -> Tuple[gpd.GeoDataFrame, gpd.GeoDataFrame, pd.DataFrame]:
+    return make_city()
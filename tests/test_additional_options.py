@@ -0,0 +1,62 @@
+import numpy as np
+import pandas as pd
+from scipy import sparse
+
+from provisio.utils import additional_options
+
+
+def _baseline_additional_options(buildings, services, matrix, destination_matrix, normative_distance):
+    # the row by row loop additional_options replaced, on dense services x buildings frames
+    buildings["supplyed_demands_within"] = 0
+    buildings["supplyed_demands_without"] = 0
+    services["carried_capacity_within"] = 0
+    services["carried_capacity_without"] = 0
+    for i in range(len(destination_matrix)):
+        loc = destination_matrix.iloc[i]
+        s = matrix.loc[loc.name] <= normative_distance
+        within = loc[s]
+        without = loc[~s]
+        within = within[within > 0]
+        without = without[without > 0]
+        buildings["demand_left"] = buildings["demand_left"].sub(within.add(without, fill_value=0), fill_value=0)
+        buildings["supplyed_demands_within"] = buildings["supplyed_demands_within"].add(within, fill_value=0)
+        buildings["supplyed_demands_without"] = buildings["supplyed_demands_without"].add(without, fill_value=0)
+        services.at[loc.name, "capacity_left"] = (
+            services.at[loc.name, "capacity_left"] - within.add(without, fill_value=0).sum()
+        )
+        services.at[loc.name, "carried_capacity_within"] = (
+            services.at[loc.name, "carried_capacity_within"] + within.sum()
+        )
+        services.at[loc.name, "carried_capacity_without"] = (
+            services.at[loc.name, "carried_capacity_without"] + without.sum()
+        )
+    buildings["provison_value"] = buildings["supplyed_demands_within"] / buildings["demand"]
+    services["service_load"] = services["capacity"] - services["capacity_left"]
+
+
+def test_additional_options_matches_baseline_loop(city):
+    buildings, services, matrix = city
+    buildings = pd.DataFrame(buildings.drop(columns="geometry")).assign(demand_left=buildings["demand"])
+    services = pd.DataFrame(services.drop(columns="geometry")).assign(capacity_left=services["capacity"])
+    distances = matrix.T.fillna(np.inf)
+    rng = np.random.default_rng(1)
+    flows = pd.DataFrame(
+        np.where(np.isfinite(distances) & (rng.random(distances.shape) < 0.3), rng.integers(0, 4, distances.shape), 0),
+        distances.index,
+        distances.columns,
+    )
+
+    expected_buildings, expected_services = buildings.copy(), services.copy()
+    _baseline_additional_options(expected_buildings, expected_services, distances, flows, 10)
+
+    reachable = np.isfinite(distances.to_numpy())
+    rows, cols = np.nonzero(reachable)
+    distance_matrix = sparse.csr_matrix((distances.to_numpy()[reachable], (rows, cols)), shape=distances.shape)
+    destination_matrix = sparse.csr_matrix(
+        (flows.to_numpy()[rows, cols].astype(float), distance_matrix.indices, distance_matrix.indptr),
+        shape=distances.shape,
+    )
+    additional_options(buildings, services, distance_matrix, destination_matrix, 10)
+
+    pd.testing.assert_frame_equal(buildings, expected_buildings, check_dtype=False)
+    pd.testing.assert_frame_equal(services, expected_services, check_dtype=False)
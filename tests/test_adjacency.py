@@ -0,0 +1,28 @@
+import pandas as pd
+import pytest
+
+from provisio import load_adjacency_matrix, save_adjacency_matrix
+from provisio.adjacency import select_adjacency_matrix
+from provisio.provisio_exceptions import AdjacencyMatrixValueError
+
+
+@pytest.mark.parametrize("services_labels", [None, "str"])
+def test_saved_matrix_loads_memory_mapped_with_labels(city, tmp_path, services_labels):
+    buildings, services, matrix = city
+    if services_labels == "str":
+        matrix = matrix.set_axis([f"service_{label}" for label in matrix.columns], axis=1)
+
+    save_adjacency_matrix(matrix, str(tmp_path))
+    loaded = load_adjacency_matrix(str(tmp_path))
+
+    assert loaded.services_index.equals(matrix.columns)
+    expected = select_adjacency_matrix(matrix, buildings.index, matrix.columns)
+    selected = loaded.select(buildings.index, matrix.columns)
+    assert (selected != expected).nnz == 0
+
+
+def test_saving_object_labels_raises(city, tmp_path):
+    _, _, matrix = city
+    matrix = matrix.set_axis([("service", label) for label in matrix.columns], axis=1)
+    with pytest.raises(AdjacencyMatrixValueError):
+        save_adjacency_matrix(matrix, str(tmp_path))
@@ -0,0 +1,39 @@
+import numpy as np
+import pandas as pd
+import pytest
+from scipy import sparse
+
+from provisio import get_service_provision, get_service_provision_batch
+from tests.conftest import make_city
+
+
+@pytest.fixture
+def two_types():
+    buildings, schools, schools_matrix = make_city(seed=0)
+    _, clinics, clinics_matrix = make_city(seed=1)
+    # both types have a default RangeIndex, so their labels overlap
+    buildings = buildings.assign(population=buildings["demand"] * 10)
+    return buildings, {"schools": (schools, schools_matrix), "clinics": (clinics, clinics_matrix)}
+
+
+def test_batch_with_overlapping_services_index_matches_single_calls(two_types):
+    buildings, types = two_types
+    matrix = sparse.hstack([sparse.coo_matrix(np.nan_to_num(m.to_numpy(), nan=np.inf)) for _, m in types.values()])
+
+    results = get_service_provision_batch(
+        buildings, matrix, {name: (gdf, 0.1, 10) for name, (gdf, _) in types.items()}, max_workers=2
+    )
+
+    demanded = buildings.assign(demand=buildings["population"] * 0.1)
+    for name, (gdf, type_matrix) in types.items():
+        _, expected_services, expected_links = get_service_provision(demanded, type_matrix, gdf, 10)
+        _, batch_services, batch_links = results[name]
+        pd.testing.assert_frame_equal(batch_services, expected_services)
+        pd.testing.assert_frame_equal(batch_links, expected_links)
+
+
+def test_batch_with_overlapping_labels_of_labelled_matrix_raises(two_types):
+    buildings, types = two_types
+    matrix = pd.concat([m for _, m in types.values()], axis=1)
+    with pytest.raises(ValueError):
+        get_service_provision_batch(buildings, matrix, {name: (gdf, 0.1, 10) for name, (gdf, _) in types.items()})
@@ -0,0 +1,73 @@
+import os
+
+import pandas as pd
+from loguru import logger
+
+from provisio import ProvisionCache, get_service_provision
+
+
+def _assert_same_result(result, expected):
+    for frame, expected_frame in zip(result, expected):
+        pd.testing.assert_frame_equal(frame, expected_frame, check_dtype=False)
+
+
+def _entry_size(cache, key):
+    entry = os.path.join(cache.path, key)
+    return sum(os.path.getsize(os.path.join(entry, name)) for name in os.listdir(entry))
+
+
+def test_cached_result_round_trips(city, tmp_path):
+    buildings, services, matrix = city
+    cache = ProvisionCache(str(tmp_path))
+
+    calculated = get_service_provision(buildings, matrix, services, 10, cache=cache)
+    cached = get_service_provision(buildings, matrix, services, 10, cache=cache)
+
+    assert (cache.misses, cache.hits) == (1, 1)
+    _assert_same_result(cached, calculated)
+
+
+def test_changed_inputs_miss(city, tmp_path):
+    buildings, services, matrix = city
+    cache = ProvisionCache(str(tmp_path))
+
+    get_service_provision(buildings, matrix, services, 10, cache=cache)
+    get_service_provision(buildings, matrix, services, 15, cache=cache)
+    get_service_provision(buildings, matrix, services.assign(capacity=services["capacity"] + 1), 10, cache=cache)
+
+    assert (cache.misses, cache.hits) == (3, 0)
+
+
+def test_result_which_can_not_be_stored_is_returned(city, tmp_path):
+    buildings, services, matrix = city
+    buildings[5] = 1
+    cache = ProvisionCache(str(tmp_path))
+    warnings = []
+    handler = logger.add(warnings.append, level="WARNING")
+    try:
+        result = get_service_provision(buildings, matrix, services, 10, cache=cache)
+    finally:
+        logger.remove(handler)
+
+    _assert_same_result(result, get_service_provision(buildings, matrix, services, 10))
+    assert len(warnings) == 1 and "not cached" in warnings[0]
+    assert os.listdir(tmp_path) == []
+
+
+def test_least_recently_used_entries_are_evicted(city, tmp_path):
+    buildings, services, matrix = city
+    cache = ProvisionCache(str(tmp_path))
+    results = {threshold: get_service_provision(buildings, matrix, services, threshold) for threshold in (5, 10, 15)}
+    keys = {threshold: cache.key(buildings, matrix, services, threshold=threshold) for threshold in results}
+
+    assert cache.put(keys[5], results[5])
+    cache.max_size = 2.5 * _entry_size(cache, keys[5])
+    assert cache.put(keys[10], results[10])
+    os.utime(os.path.join(cache.path, keys[5]), (0, 0))
+    os.utime(os.path.join(cache.path, keys[10]), (1, 1))
+    cache.get(keys[5])
+    assert cache.put(keys[15], results[15])
+
+    assert sorted(os.listdir(tmp_path)) == sorted([keys[5], keys[15]])
+    _assert_same_result(cache.get(keys[5]), results[5])
+    assert cache.get(keys[10]) is None
@@ -0,0 +1,121 @@
+import numpy as np
+import pandas as pd
+import pytest
+from scipy import sparse
+
+from provisio.provision_logic import CityProvision
+from tests.conftest import make_city
+
+CALCULATION_TYPES = ["linear", "gravity_expected"]
+
+
+@pytest.fixture
+def scenario_city():
+    # a short max distance splits the city into several groups of connected services
+    return make_city(n_buildings=600, n_services=80, size=4_000, max_distance=15, seed=3)
+
+
+def _provision(buildings, services, matrix, calculation_type):
+    return CityProvision(
+        services=services,
+        demanded_buildings=buildings,
+        adjacency_matrix=matrix,
+        threshold=10,
+        calculation_type=calculation_type,
+        links_geometry=False,
+    )
+
+
+def _assert_same_provision(result, expected):
+    buildings, services, links = result
+    expected_buildings, expected_services, expected_links = expected
+    pd.testing.assert_frame_equal(buildings, expected_buildings, check_dtype=False, atol=1e-6)
+    pd.testing.assert_frame_equal(services, expected_services.loc[services.index], check_dtype=False, atol=1e-6)
+    key = ["building_index", "service_index"]
+    pd.testing.assert_frame_equal(
+        links.sort_values(key, ignore_index=True),
+        expected_links.sort_values(key, ignore_index=True),
+        check_dtype=False,
+        atol=1e-6,
+    )
+
+
+@pytest.mark.parametrize("calculation_type", CALCULATION_TYPES)
+def test_set_capacity_matches_full_recomputation(scenario_city, calculation_type):
+    buildings, services, matrix = scenario_city
+    provision = _provision(buildings, services, matrix, calculation_type)
+    provision.get_provisions()
+    capacity = pd.Series([200, 3], index=[3, 7])
+
+    result = provision.set_capacity(capacity)
+
+    changed = services.copy()
+    changed.loc[capacity.index, "capacity"] = capacity
+    _assert_same_provision(result, _provision(buildings, changed, matrix, calculation_type).get_provisions())
+
+
+@pytest.mark.parametrize("calculation_type", CALCULATION_TYPES)
+def test_add_services_matches_full_recomputation(scenario_city, calculation_type):
+    buildings, services, matrix = scenario_city
+    provision = _provision(buildings, services, matrix, calculation_type)
+    provision.get_provisions()
+    new_services = services.iloc[:2].set_axis([1000, 1001]).assign(capacity=[80, 90])
+    new_matrix = matrix[[0, 1]].set_axis([1000, 1001], axis=1)
+
+    result = provision.add_services(new_services, new_matrix)
+
+    expected = _provision(
+        buildings, pd.concat([services, new_services]), pd.concat([matrix, new_matrix], axis=1), calculation_type
+    ).get_provisions()
+    _assert_same_provision(result, expected)
+
+
+@pytest.mark.parametrize("calculation_type", CALCULATION_TYPES)
+def test_remove_services_matches_full_recomputation(scenario_city, calculation_type):
+    buildings, services, matrix = scenario_city
+    provision = _provision(buildings, services, matrix, calculation_type)
+    provision.get_provisions()
+
+    result = provision.remove_services([5, 9])
+
+    expected = _provision(
+        buildings, services.drop([5, 9]), matrix.drop(columns=[5, 9]), calculation_type
+    ).get_provisions()
+    _assert_same_provision(result, expected)
+
+
+def test_exact_neighbourhood_is_local(scenario_city):
+    buildings, services, matrix = scenario_city
+    provision = _provision(buildings, services, matrix, "linear")
+    provision.get_provisions()
+    # pylint: disable=protected-access
+    assert 1 < len(provision._neighbourhood([5])) < len(provision.services)
+
+
+def test_delta_keeps_earlier_results(scenario_city):
+    buildings, services, matrix = scenario_city
+    provision = _provision(buildings, services, matrix, "linear")
+    base_buildings, base_services, _ = provision.get_provisions()
+    expected_buildings, expected_services = base_buildings.copy(), base_services.copy()
+
+    provision.set_capacity(pd.Series([200], index=[3]))
+    provision.remove_services([5])
+
+    pd.testing.assert_frame_equal(base_buildings, expected_buildings)
+    pd.testing.assert_frame_equal(base_services, expected_services)
+
+
+def test_add_services_with_positional_matrix_of_constructor_buildings(scenario_city):
+    buildings, services, matrix = scenario_city
+    buildings = buildings.assign(demand=buildings["demand"].where(buildings.index % 10 != 0, 0))
+    provision = _provision(buildings, services, matrix, "linear")
+    provision.get_provisions()
+    new_services = services.iloc[:2].set_axis([1000, 1001])
+    new_matrix = (matrix[[0, 1]] + 0.3).set_axis([1000, 1001], axis=1)
+
+    result = provision.add_services(new_services, sparse.csr_matrix(new_matrix.fillna(np.inf).to_numpy()))
+
+    expected = _provision(
+        buildings, pd.concat([services, new_services]), pd.concat([matrix, new_matrix], axis=1), "linear"
+    ).get_provisions()
+    _assert_same_provision(result, expected)
@@ -0,0 +1,20 @@
+import asyncio
+
+from provisio import ProvisionJobQueue
+
+
+def test_submissions_passing_defaults_explicitly_are_coalesced(city):
+    buildings, services, matrix = city
+
+    async def submit_both():
+        async with ProvisionJobQueue(max_workers=1) as queue:
+            implicit = await queue.submit(buildings, matrix, services, 10)
+            explicit = await queue.submit(buildings, matrix, services, 10, calculation_type="gravity", seed=0)
+            other = await queue.submit(buildings, matrix, services, 10, calculation_type="linear")
+            await asyncio.gather(implicit, explicit, other)
+            return implicit, explicit, other
+
+    implicit, explicit, other = asyncio.run(submit_both())
+
+    assert implicit.key == explicit.key
+    assert implicit.key != other.key
@@ -0,0 +1,53 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from provisio import get_service_provision, get_service_provision_joint
+
+CAPACITY_COLUMNS = ["capacity", "capacity_left", "carried_capacity_within", "carried_capacity_without", "service_load"]
+
+
+def _split_types(services, weights):
+    half = len(services) // 2
+    return {"first": (services.iloc[:half], weights[0]), "second": (services.iloc[half:], weights[1])}
+
+
+@pytest.mark.parametrize("calculation_type", ["gravity", "linear"])
+def test_unit_weights_match_one_call_over_all_services(city, calculation_type):
+    buildings, services, matrix = city
+
+    expected = get_service_provision(buildings, matrix, services, 10, calculation_type, links_geometry=False, seed=3)
+    joint_buildings, joint_services, joint_links = get_service_provision_joint(
+        buildings, matrix, _split_types(services, (1, 1)), 10, calculation_type, links_geometry=False, seed=3
+    )
+
+    pd.testing.assert_frame_equal(joint_buildings, expected[0])
+    pd.testing.assert_frame_equal(pd.concat(joint_services.values()), expected[1])
+    pd.testing.assert_frame_equal(joint_links.drop(columns="service_type"), expected[2])
+    assert (
+        joint_links["service_type"]
+        == np.where(joint_links["service_index"].isin(joint_services["first"].index), "first", "second")
+    ).all()
+
+
+def test_weights_convert_capacity_back_to_own_units(city):
+    buildings, services, matrix = city
+    weights = (2, 0.5)
+    types = _split_types(services, weights)
+    scaled_services = pd.concat(
+        [type_services.assign(capacity=type_services["capacity"] * weight) for type_services, weight in types.values()]
+    )
+
+    expected = get_service_provision(buildings, matrix, scaled_services, 10, links_geometry=False, seed=3)
+    joint_buildings, joint_services, _ = get_service_provision_joint(
+        buildings, matrix, types, 10, links_geometry=False, seed=3
+    )
+
+    pd.testing.assert_frame_equal(joint_buildings, expected[0])
+    for service_type, (type_services, weight) in types.items():
+        result = joint_services[service_type]
+        own_units = expected[1].loc[type_services.index, CAPACITY_COLUMNS] / weight
+        pd.testing.assert_frame_equal(result[CAPACITY_COLUMNS], own_units, check_dtype=False)
+        pd.testing.assert_series_equal(result["capacity"], type_services["capacity"], check_dtype=False)
+        assert (result["service_load"] <= result["capacity"]).all()
+        assert (result["capacity_left"] == result["capacity"] - result["service_load"]).all()
@@ -0,0 +1,306 @@
+import geopandas as gpd
+import numpy as np
+import pandas as pd
+import pytest
+from scipy import optimize, sparse
+from shapely.geometry import Point
+
+from provisio import get_service_accessibility, get_service_provision, provision_logic
+from provisio.provision_logic import CityProvision
+from tests.conftest import make_city
+
+
+def _city_arrays(buildings, services, matrix):
+    """Demand, capacity and the services x buildings CSR matrix of finite distances of a `make_city` city."""
+    distances = matrix.T.to_numpy()
+    rows, cols = np.nonzero(np.isfinite(distances))
+    return (
+        buildings["demand"].to_numpy(float),
+        services["capacity"].to_numpy(float),
+        sparse.csr_matrix((distances[rows, cols], (rows, cols)), shape=distances.shape),
+    )
+
+
+def _assert_within_bounds(flows, demand, capacity, distance_matrix):
+    rows = np.repeat(np.arange(distance_matrix.shape[0]), np.diff(distance_matrix.indptr))
+    assert (flows >= 0).all()
+    assert (np.bincount(rows, flows, minlength=len(capacity)) <= capacity + 1e-6).all()
+    assert (np.bincount(distance_matrix.indices, flows, minlength=len(demand)) <= demand + 1e-6).all()
+
+
+def _assert_exhausted(flows, demand, capacity, distance_matrix):
+    # no reachable pair is left between a service and a building that both have a whole unit left
+    rows = np.repeat(np.arange(distance_matrix.shape[0]), np.diff(distance_matrix.indptr))
+    capacity_left = capacity - np.bincount(rows, flows, minlength=len(capacity))
+    demand_left = demand - np.bincount(distance_matrix.indices, flows, minlength=len(demand))
+    assert not ((capacity_left[rows] >= 1) & (demand_left[distance_matrix.indices] >= 1)).any()
+
+
+def _draw(p, n):
+    return np.bincount(np.random.default_rng(seed=0).choice(len(p), int(n), p=p / p.sum()), minlength=len(p))
+
+
+def _baseline_gravity(demand, capacity, distances, selection_range):
+    # the recursive pandas loop the gravity engine replaced, iterative and stopping once no reachable pair is left
+    demand_left, capacity_left = demand.astype(float), capacity.astype(float)
+    destination = pd.DataFrame(0.0, distances.index, distances.columns)
+    while distances.notna().to_numpy().any():
+        flows = pd.DataFrame(0.0, distances.index, distances.columns)
+        for service, row in distances.iterrows():
+            row = row[row <= selection_range]
+            if len(row) > 0:
+                flows.loc[service, row.index] = _draw((demand_left[row.index] / row).to_numpy(), capacity_left[service])
+        for building, column in flows.items():
+            column = column[column > 0]
+            if len(column) > 0:
+                drawn = _draw(column.to_numpy(), demand_left[building])
+                flows.loc[column.index, building] = np.minimum(column.to_numpy(), drawn)
+        destination = destination.add(flows, fill_value=0)
+        capacity_left = capacity - destination.sum(axis=1)
+        demand_left = demand - destination.sum(axis=0)
+        distances = distances.drop(
+            index=capacity_left.index[capacity_left == 0], columns=demand_left.index[demand_left == 0], errors="ignore"
+        )
+        selection_range += selection_range
+    return destination
+
+
+@pytest.mark.parametrize("capacity_scale", [1, 5])
+def test_gravity_stays_within_capacity_and_demand(city, capacity_scale):
+    buildings, services, matrix = city
+    demand, capacity, distance_matrix = _city_arrays(buildings, services, matrix)
+    capacity = capacity * capacity_scale
+
+    flows = CityProvision._solve(demand, capacity, distance_matrix, 10, "gravity")
+
+    assert np.array_equal(flows, np.round(flows))
+    _assert_within_bounds(flows, demand, capacity, distance_matrix)
+    _assert_exhausted(flows, demand, capacity, distance_matrix)
+
+
+def test_gravity_loop_ends_once_whole_matrix_is_in_range():
+    # the far building is only reached after the selection range doubles past its distance
+    distance_matrix = sparse.csr_matrix(np.array([[1.0, 50.0]]))
+    events = []
+
+    flows = CityProvision._provision_loop_gravity(
+        np.array([1.0, 1.0]), np.array([100.0]), distance_matrix, 1, lambda event, payload: events.append(payload)
+    )
+
+    assert np.array_equal(flows, [1, 1])
+    assert [event["threshold"] for event in events] == [1, 2, 4, 8, 16, 32, 64]
+
+
+def test_gravity_loop_returns_at_once_without_whole_units_of_demand():
+    distance_matrix = sparse.csr_matrix(np.array([[1.0, 3.0], [2.0, 5.0]]))
+    events = []
+
+    flows = CityProvision._provision_loop_gravity(
+        np.array([0.0, 0.5]), np.array([10.0, 10.0]), distance_matrix, 1, lambda event, payload: events.append(payload)
+    )
+
+    assert not flows.any()
+    assert events == []
+
+
+@pytest.mark.parametrize("seed", [0, 1, 2])
+@pytest.mark.parametrize("capacity_scale", [1, 5])
+def test_gravity_is_close_to_baseline_loop(seed, capacity_scale):
+    buildings, services, matrix = make_city(seed=seed)
+    services["capacity"] *= capacity_scale
+
+    expected = _baseline_gravity(buildings["demand"], services["capacity"], matrix.T, 10)
+    _, provision_services, _ = get_service_provision(buildings, matrix, services, 10, links_geometry=False)
+
+    within = (matrix.T <= 10).to_numpy()
+    assert provision_services["service_load"].sum() == pytest.approx(expected.to_numpy().sum(), rel=0.02)
+    assert provision_services["carried_capacity_within"].sum() == pytest.approx(
+        expected.to_numpy()[within].sum(), rel=0.1
+    )
+
+
+@pytest.mark.parametrize("threshold, expected", [(10, [0, 1, 1, 0]), (1, [1, 0, 0, 1])])
+def test_linear_finds_known_optimal_assignment(threshold, expected):
+    # crossing (1/3 + 1/3) beats the nearest pair plus the far one (1/2 + 1/11) once all pairs are in range,
+    # a threshold of 1 fixes the nearest pair before the others come into range
+    distance_matrix = sparse.csr_matrix(np.array([[1.0, 2.0], [2.0, 10.0]]))
+
+    flows = CityProvision._solve(np.ones(2), np.ones(2), distance_matrix, threshold, "linear")
+
+    assert np.array_equal(flows, expected)
+
+
+def test_linear_flows_are_whole_units_within_capacity_and_demand(city):
+    buildings, services, matrix = city
+    demand, capacity, distance_matrix = _city_arrays(buildings, services, matrix)
+    demand, capacity = demand + 0.5, capacity * 3 + 0.5
+
+    flows = CityProvision._solve(demand, capacity, distance_matrix, 10, "linear")
+
+    assert np.array_equal(flows, np.round(flows))
+    _assert_within_bounds(flows, demand, capacity, distance_matrix)
+    _assert_exhausted(flows, demand, capacity, distance_matrix)
+
+
+def test_linear_raises_when_solver_fails(monkeypatch):
+    monkeypatch.setattr(
+        optimize, "linprog", lambda *args, **kwargs: optimize.OptimizeResult(status=4, message="numerical difficulties")
+    )
+
+    with pytest.raises(RuntimeError, match="numerical difficulties"):
+        CityProvision._solve(np.ones(2), np.ones(2), sparse.csr_matrix(np.array([[1.0, 2.0]])), 10, "linear")
+
+
+@pytest.mark.parametrize("capacity_scale", [1, 5])
+@pytest.mark.parametrize("round_flows", [False, True])
+def test_expected_stays_within_capacity_and_demand(city, capacity_scale, round_flows):
+    buildings, services, matrix = city
+    demand, capacity, distance_matrix = _city_arrays(buildings, services, matrix)
+    capacity = capacity * capacity_scale
+
+    flows = CityProvision._solve(demand, capacity, distance_matrix, 10, "gravity_expected", round_flows=round_flows)
+
+    _assert_within_bounds(flows, demand, capacity, distance_matrix)
+    if round_flows:
+        assert np.array_equal(flows, np.round(flows))
+    else:
+        _assert_exhausted(flows, demand, capacity, distance_matrix)
+
+
+def test_rounded_expected_flows_keep_totals(city):
+    buildings, services, matrix = city
+    demand, capacity, distance_matrix = _city_arrays(buildings, services, matrix)
+
+    flows = CityProvision._solve(demand, capacity, distance_matrix, 10, "gravity_expected")
+    rounded = CityProvision._solve(demand, capacity, distance_matrix, 10, "gravity_expected", round_flows=True)
+
+    rows = np.repeat(np.arange(distance_matrix.shape[0]), np.diff(distance_matrix.indptr))
+    assert np.abs(rounded - flows).max() < 1
+    assert np.abs(np.bincount(rows, rounded) - np.bincount(rows, flows)).max() <= 0.5 + 1e-6
+
+
+class _CountingNumpy:
+    """numpy counting `bincount` calls, every balancing pass of the engines makes a fixed number of them."""
+
+    def __init__(self):
+        self.bincount_calls = 0
+
+    def __getattr__(self, name):
+        return getattr(np, name)
+
+    def bincount(self, *args, **kwargs):
+        self.bincount_calls += 1
+        return np.bincount(*args, **kwargs)
+
+
+def test_expected_cost_does_not_grow_with_capacity(city, monkeypatch):
+    buildings, services, matrix = city
+    demand, _, distance_matrix = _city_arrays(buildings, services, matrix)
+    calls = {}
+    for capacity in (50, 50_000):
+        counting = _CountingNumpy()
+        monkeypatch.setattr(provision_logic, "np", counting)
+        flows = CityProvision._solve(
+            demand * capacity / 50,
+            np.full(len(services), capacity, dtype=float),
+            distance_matrix,
+            10,
+            "gravity_expected",
+        )
+        monkeypatch.undo()
+        calls[capacity] = counting.bincount_calls
+        assert flows.sum() > 0
+
+    assert calls[50_000] == calls[50]
+
+
+def _sorted_links(links):
+    return links.sort_values(["building_index", "service_index"], ignore_index=True)
+
+
+@pytest.mark.parametrize("calculation_type", ["gravity", "linear"])
+def test_int_seed_result_does_not_depend_on_rows_order(city, calculation_type):
+    buildings, services, matrix = city
+    rng = np.random.default_rng(7)
+    shuffled_buildings = buildings.take(rng.permutation(len(buildings)))
+    shuffled_services = services.take(rng.permutation(len(services)))
+
+    expected = get_service_provision(buildings, matrix, services, 10, calculation_type, links_geometry=False, seed=3)
+    result = get_service_provision(
+        shuffled_buildings, matrix, shuffled_services, 10, calculation_type, links_geometry=False, seed=3
+    )
+
+    pd.testing.assert_frame_equal(result[0].loc[expected[0].index], expected[0])
+    pd.testing.assert_frame_equal(result[1].loc[expected[1].index], expected[1])
+    pd.testing.assert_frame_equal(_sorted_links(result[2]), _sorted_links(expected[2]))
+
+
+def test_int_seed_tiled_result_does_not_depend_on_workers():
+    buildings, services, matrix = make_city(n_buildings=600, n_services=40, size=3_000, max_distance=40, seed=0)
+    params = {"links_geometry": False, "tile_size": 700, "seed": 3}
+
+    serial = get_service_provision(buildings, matrix, services, 10, **params)
+    parallel = get_service_provision(buildings, matrix, services, 10, max_workers=2, **params)
+
+    for frame, expected_frame in zip(parallel, serial):
+        pd.testing.assert_frame_equal(frame, expected_frame)
+
+
+def test_results_do_not_alias_inputs(city):
+    buildings, services, matrix = city
+    buildings["population"] = buildings["demand"] * 10
+    services["floors"] = 2
+    buildings_before, services_before = buildings.copy(), services.copy()
+
+    provision_buildings, provision_services, _ = get_service_provision(buildings, matrix, services, 10)
+    provision_buildings.loc[provision_buildings.index[0], "population"] = -1
+    provision_services.loc[provision_services.index[0], "floors"] = -1
+
+    assert buildings.equals(buildings_before)
+    assert services.equals(services_before)
+    assert "demand_left" not in buildings.columns
+
+
+def test_inplace_results_are_the_inputs(city):
+    buildings, services, matrix = city
+
+    provision_buildings, provision_services, _ = get_service_provision(buildings, matrix, services, 10, inplace=True)
+
+    assert provision_buildings is buildings
+    assert provision_services is services
+    assert "demand_left" in buildings.columns
+
+
+def test_accessibility_results_do_not_alias_inputs(city):
+    buildings, services, matrix = city
+    buildings_before = buildings.copy()
+
+    accessibility_buildings, _ = get_service_accessibility(buildings, matrix, services, 10)
+    accessibility_buildings.loc[accessibility_buildings.index[0], "demand"] = -1
+
+    assert buildings.equals(buildings_before)
+    assert "accessibility" in accessibility_buildings.columns
+
+
+@pytest.mark.parametrize(
+    "decay, demand_within, capacity_within, accessibility",
+    [
+        # within 10: s0 reaches b0, b1 and s1 reaches b1, b2, so ratios are 6 / 30 and 25 / 50
+        (None, [30, 50], [6, 31, 25], [0.2, 0.7, 0.5]),
+        # weights 1 / d: ratios are 6 / (10/2 + 20/5) and 25 / (20/8 + 30/4)
+        (lambda d: 1 / d, [9, 10], [3, 6 / 5 + 25 / 8, 25 / 4], [1 / 3, 2 / 15 + 2.5 / 8, 2.5 / 4]),
+    ],
+)
+def test_accessibility_matches_hand_computed_catchments(decay, demand_within, capacity_within, accessibility):
+    buildings = gpd.GeoDataFrame({"demand": [10, 20, 30]}, geometry=[Point(0, 0), Point(1, 0), Point(2, 0)])
+    services = gpd.GeoDataFrame({"capacity": [6, 25]}, geometry=[Point(0, 1), Point(2, 1)])
+    matrix = pd.DataFrame([[2, np.nan], [5, 8], [12, 4]], index=buildings.index, columns=services.index)
+
+    accessibility_buildings, accessibility_services = get_service_accessibility(buildings, matrix, services, 10, decay)
+
+    assert accessibility_services["demand_within"].tolist() == pytest.approx(demand_within)
+    assert accessibility_services["supply_ratio"].tolist() == pytest.approx(
+        (services["capacity"] / demand_within).tolist()
+    )
+    assert accessibility_buildings["capacity_within"].tolist() == pytest.approx(capacity_within)
+    assert accessibility_buildings["accessibility"].tolist() == pytest.approx(accessibility)
@@ -0,0 +1,62 @@
+import numpy as np
+import pytest
+
+from provisio.provision_logic import CityProvision
+from tests.conftest import make_city
+
+CALCULATION_TYPES = ["gravity", "gravity_expected", "linear"]
+
+
+@pytest.fixture
+def wide_city():
+    return make_city(n_buildings=600, n_services=40, size=3_000, max_distance=40, seed=0)
+
+
+def _solved(buildings, services, matrix, calculation_type, **params):
+    provision = CityProvision(
+        services=services,
+        demanded_buildings=buildings,
+        adjacency_matrix=matrix,
+        threshold=10,
+        calculation_type=calculation_type,
+        links_geometry=False,
+        **params,
+    )
+    provision.get_provisions()
+    return provision
+
+
+@pytest.mark.parametrize("calculation_type", CALCULATION_TYPES)
+@pytest.mark.parametrize("capacity_scale", [1, 5])
+def test_tiled_totals_match_untiled(wide_city, calculation_type, capacity_scale):
+    buildings, services, matrix = wide_city
+    services = services.assign(capacity=services["capacity"] * capacity_scale)
+    tiles = []
+
+    untiled = _solved(buildings, services, matrix, calculation_type)
+    tiled = _solved(
+        buildings, services, matrix, calculation_type, tile_size=700, callback=lambda event, _: tiles.append(event)
+    )
+
+    assert tiles.count("tile") > 1
+    assert tiled._destination_matrix.sum() == pytest.approx(untiled._destination_matrix.sum(), rel=0.01)
+
+
+@pytest.mark.parametrize("calculation_type", CALCULATION_TYPES)
+@pytest.mark.parametrize("capacity_scale", [1, 5])
+def test_tiled_flows_stay_within_capacity_and_demand(wide_city, calculation_type, capacity_scale):
+    buildings, services, matrix = wide_city
+    services = services.assign(capacity=services["capacity"] * capacity_scale)
+
+    provision = _solved(buildings, services, matrix, calculation_type, tile_size=700)
+
+    distance_matrix, flows = provision._distance_matrix, provision._destination_matrix.data
+    rows = np.repeat(np.arange(distance_matrix.shape[0]), np.diff(distance_matrix.indptr))
+    capacity = provision.services["capacity"].to_numpy()
+    demand = provision.demanded_buildings["demand"].to_numpy()
+    capacity_left = capacity - np.bincount(rows, flows, minlength=distance_matrix.shape[0])
+    demand_left = demand - np.bincount(distance_matrix.indices, flows, minlength=distance_matrix.shape[1])
+    assert (flows >= 0).all()
+    assert (capacity_left >= -1e-6).all() and (demand_left >= -1e-6).all()
+    # reconciliation leaves no reachable pair with a whole unit on both sides
+    assert not ((capacity_left[rows] >= 1) & (demand_left[distance_matrix.indices] >= 1)).any()
@@ -0,0 +1,87 @@
+import geopandas as gpd
+import pandas as pd
+import pytest
+import shapely
+
+from provisio import get_service_provision, is_shown, write_links
+
+
+def _links_chunks(city, links_geometry=True):
+    buildings, services, matrix = city
+    _, _, links = get_service_provision(buildings, matrix, services, 10, links_geometry=links_geometry)
+    _, _, chunks = get_service_provision(
+        buildings, matrix, services, 10, links_geometry=links_geometry, links_chunk_size=500
+    )
+    return links, chunks
+
+
+def _sorted_links(links):
+    return links.sort_values(["building_index", "service_index"], ignore_index=True)
+
+
+@pytest.mark.parametrize("extension", [".parquet", ".fgb"])
+def test_written_links_round_trip(city, tmp_path, extension):
+    links, chunks = _links_chunks(city)
+    path = str(tmp_path / f"links{extension}")
+
+    count = write_links(chunks, path)
+
+    written = gpd.read_parquet(path) if extension == ".parquet" else gpd.read_file(path)
+    # FlatGeobuf stores features in its spatial index order
+    written, links = _sorted_links(written), _sorted_links(links)
+    assert count == len(links)
+    pd.testing.assert_frame_equal(
+        pd.DataFrame(written.drop(columns="geometry")), pd.DataFrame(links.drop(columns="geometry")), check_dtype=False
+    )
+    assert written.geometry.geom_equals_exact(links.geometry, 1e-6).all()
+    assert written.crs == links.crs
+
+
+@pytest.mark.parametrize("extension", [".parquet", ".fgb"])
+def test_links_after_empty_first_chunk_are_written(city, tmp_path, extension):
+    links, _ = _links_chunks(city)
+    path = str(tmp_path / f"links{extension}")
+
+    count = write_links(iter([links.iloc[:0], links.iloc[:100], links.iloc[:0], links.iloc[100:]]), path)
+
+    written = gpd.read_parquet(path) if extension == ".parquet" else gpd.read_file(path)
+    assert count == len(written) == len(links)
+
+
+def test_only_empty_chunks_write_an_empty_file(city, tmp_path):
+    links, _ = _links_chunks(city)
+    path = str(tmp_path / "links.parquet")
+
+    assert write_links(iter([links.iloc[:0]]), path) == 0
+    assert len(gpd.read_parquet(path)) == 0
+
+
+def test_links_without_geometry_are_written_to_parquet_only(city, tmp_path):
+    links, chunks = _links_chunks(city, links_geometry=False)
+
+    assert write_links(chunks, str(tmp_path / "links.parquet")) == len(links)
+    pd.testing.assert_frame_equal(pd.read_parquet(tmp_path / "links.parquet"), links, check_dtype=False)
+    with pytest.raises(ValueError, match="only be written to Parquet"):
+        write_links(iter([links]), str(tmp_path / "links.fgb"))
+
+
+def test_shown_selection_matches_overlay(city):
+    buildings, services, _ = city
+    links, _ = _links_chunks(city)
+    # overlapping zones, buildings inside both must be selected once
+    selection_zone = gpd.GeoDataFrame(
+        geometry=[shapely.box(100, 100, 500, 400), shapely.box(300, 300, 700, 600)], crs=buildings.crs
+    )
+    inputs = [frame.copy() for frame in (buildings, services, links, selection_zone)]
+
+    shown_buildings, shown_services, shown_links = is_shown(buildings, services, links, selection_zone)
+
+    for frame, frame_before in zip((buildings, services, links, selection_zone), inputs):
+        pd.testing.assert_frame_equal(frame, frame_before)
+    overlay = gpd.overlay(buildings.assign(building_id=buildings.index), selection_zone, how="intersection")
+    expected_buildings = buildings.loc[buildings.index.isin(overlay["building_id"])]
+    expected_links = links[links["building_index"].isin(expected_buildings.index)]
+    assert len(expected_buildings) > 0
+    pd.testing.assert_frame_equal(shown_buildings, expected_buildings)
+    pd.testing.assert_frame_equal(shown_links, expected_links)
+    pd.testing.assert_frame_equal(shown_services, services[services.index.isin(expected_links["service_index"])])